@@ -0,0 +1,239 @@
+import sys
+import time
+import random
+import asyncio
+import hashlib
+import contextvars
+import email.utils
+import requests
+
+
+def request_key(*parts) -> str:
+    """Stable hash of the parts that make two upstream calls identical (input, provider, model...)."""
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        elif not isinstance(part, (bytes, bytearray)):
+            part = repr(part).encode("utf-8")
+        h.update(len(part).to_bytes(8, "big"))
+        h.update(part)
+    return h.hexdigest()
+
+
+class SingleFlight:
+    """
+    Coalesce identical concurrent calls: the first caller for a key starts the work,
+    later callers with the same key await the same in-flight task and share its result.
+    The task runs independently of the caller, so one client disconnecting does not
+    cancel the call for everyone else. Scope is one process (one uvicorn worker).
+    """
+
+    def __init__(self):
+        self._calls: dict[str, asyncio.Task] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn):
+        """Run fn() (a coroutine function) once per concurrent key and return its result."""
+        task = self._calls.get(key)
+        if task is None:
+            self.started += 1
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved even if every waiter went away
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._calls), "started": self.started, "coalesced": self.coalesced}
+
+
+class ProviderOverloaded(Exception):
+    """Raised when a call cannot be admitted (queue full / wait too long) or upstream keeps rate limiting.
+    Surfaced to clients as 503 with Retry-After."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UpstreamError(Exception):
+    """Non-success HTTP status from a provider, with its Retry-After hint if any."""
+
+    def __init__(self, message: str, status_code: int, retry_after: float | None = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """The request's time budget ran out before or during a step. Surfaced to clients as 504."""
+
+
+class Deadline:
+    """Monotonic time budget for one request, shared with every step it reaches via current_deadline."""
+
+    def __init__(self, seconds: float):
+        self.budget = seconds
+        self.started = time.monotonic()
+        self.expires = self.started + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def allows(self, seconds: float) -> bool:
+        """True if at least `seconds` of budget are left."""
+        return self.remaining() >= seconds
+
+    def check(self, what: str):
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(f"deadline exceeded before {what}")
+
+
+# Deadline of the request being served; tasks created while it is set inherit it
+current_deadline: contextvars.ContextVar[Deadline | None] = contextvars.ContextVar("current_deadline", default=None)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = max(burst, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Take one token (possibly going into debt) and return how long to wait before using it."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class ProviderLimiter:
+    """Token-bucket rate limit plus a max-in-flight cap, with a bounded wait queue in front."""
+
+    def __init__(self, name: str, rate: float, burst: float, max_in_flight: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.max_in_flight = max_in_flight
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+        self.in_flight = 0
+        self.shed = 0
+
+    async def run(self, fn, timeout: float | None = None):
+        """Run fn() once admitted; timeout (the caller's remaining deadline) caps the queue wait."""
+        if not self._slots.locked():
+            await self._slots.acquire()
+        else:
+            if self.waiting >= self.max_queue:
+                self.shed += 1
+                raise ProviderOverloaded(f"{self.name} queue is full", self.queue_timeout)
+            self.waiting += 1
+            wait = self.queue_timeout if timeout is None else min(self.queue_timeout, timeout)
+            try:
+                await asyncio.wait_for(self._slots.acquire(), timeout=wait)
+            except asyncio.TimeoutError:
+                self.shed += 1
+                if wait < self.queue_timeout:
+                    raise DeadlineExceeded(f"deadline exceeded waiting for {self.name}")
+                raise ProviderOverloaded(f"{self.name} is busy", self.queue_timeout)
+            finally:
+                self.waiting -= 1
+        self.in_flight += 1
+        try:
+            if self.bucket is not None:
+                delay = self.bucket.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            return await fn()
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    def stats(self) -> dict:
+        return {"in_flight": self.in_flight, "max_in_flight": self.max_in_flight, "waiting": self.waiting, "max_queue": self.max_queue, "shed": self.shed}
+
+
+_RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+def parse_retry_after(value) -> float | None:
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+        return max(when.timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_info(exc: Exception) -> tuple[int | None, float | None]:
+    """(HTTP status, Retry-After seconds) for requests, OpenAI SDK and UpstreamError exceptions."""
+    openai = sys.modules.get("openai")  # only if the SDK is already loaded
+    response = getattr(exc, "response", None)
+    status = None
+    if isinstance(exc, UpstreamError) or (openai is not None and isinstance(exc, openai.APIStatusError)):
+        status = exc.status_code
+    elif isinstance(exc, requests.HTTPError) and response is not None:
+        status = response.status_code
+    retry_after = exc.retry_after if isinstance(exc, UpstreamError) else None
+    if retry_after is None and response is not None:
+        headers = getattr(response, "headers", None) or {}
+        retry_after = parse_retry_after(headers.get("retry-after"))
+    return status, retry_after
+
+
+def is_retryable(exc: Exception) -> bool:
+    status, _ = retry_info(exc)
+    if status is not None:
+        return status in _RETRYABLE_STATUS
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError)):
+        return True
+    openai = sys.modules.get("openai")  # only if the SDK is already loaded
+    return openai is not None and isinstance(exc, (openai.APIConnectionError, openai.APITimeoutError))
+
+
+async def retry_with_backoff(fn, attempts: int, base_delay: float, max_delay: float, deadline: Deadline | None = None):
+    """Call fn() with full-jitter exponential backoff on transient errors, honouring Retry-After.
+    A rate limit that outlasts max_delay or the last attempt becomes ProviderOverloaded.
+    With a deadline, no retry is started that would sleep past it."""
+    for attempt in range(attempts):
+        try:
+            return await fn()
+        except (ProviderOverloaded, DeadlineExceeded):
+            raise
+        except Exception as exc:
+            if not is_retryable(exc):
+                raise
+            status, retry_after = retry_info(exc)
+            delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+            if retry_after is not None:
+                delay = retry_after + random.uniform(0, base_delay)
+            last = attempt == attempts - 1
+            if not last and deadline is not None and not deadline.allows(delay):
+                # A retry is still allowed but would not fit in the request's budget
+                raise DeadlineExceeded(f"deadline leaves no room to retry after: {exc}") from exc
+            if last or delay > max_delay:
+                if status == 429:
+                    raise ProviderOverloaded(f"upstream rate limited: {exc}", retry_after or delay) from exc
+                raise
+            await asyncio.sleep(delay)
@@ -1,50 +1,104 @@
 import os
+import math
+import time
+
+
+def _process_age_seconds() -> float:
+    """Seconds since the OS started this process (0 where /proc is unavailable)."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])  # field 22, starttime
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+# Startup is measured from process start, so interpreter start-up and every import below count
+_PROCESS_START = time.perf_counter() - _process_age_seconds()
+import json
+import hashlib
 from pathlib import Path
 import io
 from uuid import uuid4
 from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from fastapi.middleware.gzip import GZipMiddleware
 # Removed early utils import so .env loads first
-from openai import OpenAI
 from dotenv import load_dotenv
 import traceback
 from fastapi.middleware.cors import CORSMiddleware
-from db import SessionLocal, engine
-from models import HandwrittenText, Base, Project
+from db import SessionLocal, ReadSessionLocal, engine
+from models import HandwrittenText, Project, TextEmbedding, SummaryCache, SummaryCacheCounter, TextChunk
 from sqlalchemy.future import select
 import asyncio
-from sqlalchemy import select, or_, func as sa_func, text as sa_text
-import numpy as np
+from sqlalchemy import select, delete, or_, and_, func as sa_func, text as sa_text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DBAPIError
 from pydantic import BaseModel
-from PIL import Image
-import pytesseract
 import requests
+from migrations import run_migrations, LEGACY_EMBEDDINGS_VERSION
+from concurrency import SingleFlight, request_key, ProviderLimiter, ProviderOverloaded, UpstreamError, retry_with_backoff, parse_retry_after
+from concurrency import Deadline, DeadlineExceeded, current_deadline
+
 
 # Load environment variables from .env if present
 load_dotenv()
 
 # Now import utils so it sees env like OLLAMA_URL
-from utils import image_to_base64, ollama_generate, ollama_embedding, ollama_list_models, preprocess_image_for_ocr, pil_image_to_base64_png
-from utils import ollama_list_running_models
+from utils import image_to_base64, ollama_generate, ollama_list_models, preprocess_image_for_ocr, pil_image_to_base64_png, open_image, tesseract_image_to_string
+from utils import ollama_list_running_models, ollama_embeddings, perceptual_hash, BKTree, split_into_passages, OLLAMA_TIMEOUT
+from utils import tesseract_image_to_data, normalize_text, text_features
 
+# Heavy provider SDKs (OpenAI, NumPy, Pillow, pytesseract) are imported on first use so
+# replicas start fast, and a missing key only fails the requests that need it.
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
-    raise RuntimeError("OPENAI_API_KEY environment variable not set.")
 
 # Gemini API
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+_openai_client = None
+# Shared in-flight provider calls (OCR, embeddings, summaries) for identical concurrent requests
+_singleflight = SingleFlight()
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "800"))
+_startup_ms = None
 
-app = FastAPI()
+
+def get_openai_client():
+    global _openai_client
+    if _openai_client is None:
+        if not OPENAI_API_KEY:
+            raise HTTPException(status_code=500, detail="OPENAI_API_KEY not set")
+        from openai import OpenAI
+        # Retries are handled by call_provider so they share the rate limiter
+        _openai_client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+    return _openai_client
+
+# Fast JSON encoding when orjson is installed; compression for larger bodies (Brotli when
+# brotli-asgi is installed, which also falls back to gzip for clients without br support)
+try:
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse as FastJSONResponse
+except ImportError:
+    FastJSONResponse = JSONResponse
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+
+app = FastAPI(default_response_class=FastJSONResponse)
 
 # Ensure uploads directory exists and serve it at /uploads
 UPLOADS_DIR = Path("uploads")
 UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
 app.mount("/uploads", StaticFiles(directory=str(UPLOADS_DIR)), name="uploads")
 
+try:
+    from brotli_asgi import BrotliMiddleware
+    app.add_middleware(BrotliMiddleware, minimum_size=COMPRESS_MIN_SIZE, gzip_fallback=True)
+except ImportError:
+    app.add_middleware(GZipMiddleware, minimum_size=COMPRESS_MIN_SIZE)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Allow all origins for development
@@ -53,25 +107,37 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Create tables if they don't exist
+# Bring the schema up to date (a single version lookup when nothing is pending)
 @app.on_event("startup")
 async def on_startup():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-        # Ensure the project_id column exists even if table already created previously
-        await conn.execute(sa_text(
-            "ALTER TABLE handwritten_texts ADD COLUMN IF NOT EXISTS project_id integer REFERENCES projects(id)"
-        ))
-        await conn.execute(sa_text(
-            "CREATE INDEX IF NOT EXISTS idx_handwritten_texts_project_id ON handwritten_texts(project_id)"
-        ))
-        # Ensure the name column exists even if table already created previously
-        await conn.execute(sa_text(
-            "ALTER TABLE handwritten_texts ADD COLUMN IF NOT EXISTS name varchar(256)"
-        ))
-        await conn.execute(sa_text(
-            "CREATE INDEX IF NOT EXISTS idx_handwritten_texts_name ON handwritten_texts(name)"
-        ))
+    global _startup_ms
+    applied = await run_migrations(engine)
+    if applied:
+        print("Applied schema migrations:", applied)
+    if LEGACY_EMBEDDINGS_VERSION in applied and VECTOR_INDEX_ENABLED:
+        # Legacy vectors were just copied into text_embeddings; fold them into the index
+        _schedule_vector_index_rebuild()
+    global _backfill_task
+    if EMBEDDING_BACKFILL_INTERVAL > 0:
+        _backfill_task = asyncio.create_task(_embedding_backfill_loop())
+        _backfill_wakeup.set()
+    if VECTOR_INDEX_ENABLED:
+        _spawn(_ensure_vector_index())
+    _spawn(_text_features_backfill_logged())
+    _startup_ms = (time.perf_counter() - _PROCESS_START) * 1000
+    if _startup_ms > STARTUP_BUDGET_MS:
+        print(f"Startup took {_startup_ms:.0f} ms, over the {STARTUP_BUDGET_MS:.0f} ms budget")
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if _backfill_task:
+        _backfill_task.cancel()
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "startup_ms": round(_startup_ms, 1) if _startup_ms is not None else None, "startup_budget_ms": STARTUP_BUDGET_MS, "singleflight": _singleflight.stats(), "providers": {k: v.stats() for k, v in _limiters.items()}}
 
 DEFAULT_PROVIDER = os.getenv("LLM_PROVIDER", "openai")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3")
@@ -92,8 +158,129 @@ def is_refusal(text: str) -> bool:
     return any(marker in lowered for marker in refusal_markers)
 
 
+# Per provider/model admission control: token-bucket rate, max in-flight calls and a bounded
+# wait queue (full queue -> 503 + Retry-After), with jittered exponential backoff on 429/5xx.
+# PROVIDER_LIMITS overrides the defaults per "provider" or "provider:model", e.g.
+# {"openai": {"rate": 3}, "ollama:llava": {"max_in_flight": 1}}
+# The values are totals for the container. Limiters live in each process, so every worker takes
+# 1/PROVIDER_LIMIT_WORKERS of rate, burst and max_in_flight (defaults to WEB_CONCURRENCY, the
+# variable uvicorn reads for --workers). max_in_flight and burst never drop below 1 per worker.
+_DEFAULT_PROVIDER_LIMITS = {
+    "openai": {"rate": 5.0, "burst": 10, "max_in_flight": 16},
+    "gemini": {"rate": 2.0, "burst": 5, "max_in_flight": 8},
+    "ollama": {"rate": 0, "burst": 1, "max_in_flight": 2},
+}
+PROVIDER_LIMITS = json.loads(os.getenv("PROVIDER_LIMITS", "{}") or "{}")
+PROVIDER_QUEUE_MAX = int(os.getenv("PROVIDER_QUEUE_MAX", "32"))
+PROVIDER_QUEUE_TIMEOUT = float(os.getenv("PROVIDER_QUEUE_TIMEOUT", "20"))
+PROVIDER_MAX_RETRIES = int(os.getenv("PROVIDER_MAX_RETRIES", "3"))
+PROVIDER_BACKOFF_BASE = float(os.getenv("PROVIDER_BACKOFF_BASE", "0.5"))
+PROVIDER_BACKOFF_MAX = float(os.getenv("PROVIDER_BACKOFF_MAX", "20"))
+PROVIDER_LIMIT_WORKERS = max(1, int(os.getenv("PROVIDER_LIMIT_WORKERS") or os.getenv("WEB_CONCURRENCY") or "1"))
+_limiters: dict[str, ProviderLimiter] = {}
+
+
+def _get_limiter(provider: str, model: str) -> ProviderLimiter:
+    key = f"{provider}:{model}"
+    limiter = _limiters.get(key)
+    if limiter is None:
+        cfg = {"rate": 0, "burst": 1, "max_in_flight": 4}
+        cfg.update(_DEFAULT_PROVIDER_LIMITS.get(provider, {}))
+        cfg.update(PROVIDER_LIMITS.get(provider, {}))
+        cfg.update(PROVIDER_LIMITS.get(key, {}))
+        workers = PROVIDER_LIMIT_WORKERS
+        limiter = ProviderLimiter(
+            key, float(cfg["rate"]) / workers, max(1.0, float(cfg["burst"]) / workers), max(1, int(cfg["max_in_flight"]) // workers),
+            int(cfg.get("max_queue", PROVIDER_QUEUE_MAX)), float(cfg.get("queue_timeout", PROVIDER_QUEUE_TIMEOUT)),
+        )
+        _limiters[key] = limiter
+    return limiter
+
+
+async def call_provider(provider: str, model: str, fn):
+    """Run one upstream call (fn returns an awaitable) under the provider's limits, retrying transient errors.
+    Inside a request deadline the queue wait, retries and the call itself are bounded by the remaining budget."""
+    limiter = _get_limiter(provider, model)
+    deadline = current_deadline.get()
+    if deadline is None:
+        return await retry_with_backoff(
+            lambda: limiter.run(fn), PROVIDER_MAX_RETRIES + 1, PROVIDER_BACKOFF_BASE, PROVIDER_BACKOFF_MAX
+        )
+    deadline.check(f"{provider}:{model} call")
+    try:
+        return await asyncio.wait_for(retry_with_backoff(
+            lambda: limiter.run(fn, deadline.remaining()), PROVIDER_MAX_RETRIES + 1, PROVIDER_BACKOFF_BASE, PROVIDER_BACKOFF_MAX, deadline
+        ), timeout=deadline.remaining())
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(f"deadline exceeded during {provider}:{model} call")
+
+
+def _call_timeout(default: float) -> float:
+    """HTTP timeout for one upstream call: the default, capped by the request's remaining deadline.
+    Abandoned worker threads therefore stop waiting on the provider soon after the request gives up."""
+    deadline = current_deadline.get()
+    if deadline is None:
+        return default
+    return max(0.1, min(default, deadline.remaining()))
+
+
+@app.exception_handler(ProviderOverloaded)
+async def provider_overloaded_handler(request: Request, exc: ProviderOverloaded):
+    return JSONResponse(
+        status_code=503,
+        content={"error": str(exc)},
+        headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))},
+    )
+
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded_handler(request: Request, exc: DeadlineExceeded):
+    return JSONResponse(status_code=504, content={"error": str(exc)})
+
+
+# Per-request deadlines: ?timeout_ms= or the X-Request-Timeout-Ms header, else REQUEST_DEADLINE_MS.
+# Every provider call, embedding and DB step of the request shares the budget (see call_provider).
+REQUEST_DEADLINE_MS = int(os.getenv("REQUEST_DEADLINE_MS", "60000"))
+REQUEST_DEADLINE_MAX_MS = int(os.getenv("REQUEST_DEADLINE_MAX_MS", "300000"))
+DEADLINE_DB_MIN_MS = int(os.getenv("DEADLINE_DB_MIN_MS", "2000"))  # floor for statement_timeout on the final save
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "60"))
+
+
+def _request_deadline(request: Request, timeout_ms: int | None) -> Deadline:
+    if timeout_ms is None:
+        header = request.headers.get("x-request-timeout-ms")
+        if header:
+            try:
+                timeout_ms = int(header)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="X-Request-Timeout-Ms must be an integer number of milliseconds")
+    if timeout_ms is None:
+        timeout_ms = REQUEST_DEADLINE_MS
+    if timeout_ms <= 0:
+        raise HTTPException(status_code=400, detail="timeout_ms must be positive")
+    return Deadline(min(timeout_ms, REQUEST_DEADLINE_MAX_MS) / 1000.0)
+
+
+async def _apply_statement_timeout(session, floor_ms: int = 0):
+    """Bound the session's current transaction by the request deadline (no-op without one).
+    Without a floor, raises DeadlineExceeded when the budget is already spent."""
+    deadline = current_deadline.get()
+    if deadline is not None:
+        if not floor_ms:
+            deadline.check("database query")
+        ms = max(floor_ms, int(deadline.remaining() * 1000), 1)
+        # set_config(..., true) is SET LOCAL with a bound value: one prepared statement for every timeout
+        await session.execute(sa_text("SELECT set_config('statement_timeout', :ms, true)"), {"ms": str(ms)})
+
+
+def _is_statement_timeout(exc: Exception) -> bool:
+    return isinstance(exc, DBAPIError) and "statement timeout" in str(exc)
+
+
 async def perform_openai_ocr(img_b64: str) -> str:
-    response = client.chat.completions.create(
+    response = await call_provider("openai", "gpt-4o", lambda: asyncio.to_thread(
+        get_openai_client().with_options(timeout=_call_timeout(OPENAI_TIMEOUT)).chat.completions.create,
         model="gpt-4o",
         messages=[
             {
@@ -110,11 +297,15 @@ async def perform_openai_ocr(img_b64: str) -> str:
             }
         ],
         max_tokens=1024,
-    )
+    ))
     return response.choices[0].message.content or ""
 
 
-def _gemini_generate(parts: list[dict], model: str | None = None) -> str:
+async def perform_ollama_generate(prompt: str, model: str) -> str:
+    return await call_provider("ollama", model, lambda: asyncio.to_thread(ollama_generate, prompt, model, _call_timeout(OLLAMA_TIMEOUT)))
+
+
+def _gemini_generate(parts: list[dict], model: str | None = None, timeout: float = GEMINI_TIMEOUT) -> str:
     if not GEMINI_API_KEY:
         raise HTTPException(status_code=500, detail="GEMINI_API_KEY not set")
     model_name = model or GEMINI_MODEL
@@ -124,7 +315,10 @@ def _gemini_generate(parts: list[dict], model: str | None = None) -> str:
         "X-goog-api-key": GEMINI_API_KEY,
     }
     payload = {"contents": [{"parts": parts}]}
-    resp = requests.post(url, headers=headers, json=payload, timeout=60)
+    resp = requests.post(url, headers=headers, json=payload, timeout=timeout)
+    if resp.status_code == 429 or resp.status_code >= 500:
+        # Transient: retried with backoff by call_provider
+        raise UpstreamError(f"Gemini API error: {resp.status_code} {resp.text}", resp.status_code, parse_retry_after(resp.headers.get("retry-after")))
     if resp.status_code != 200:
         raise HTTPException(status_code=502, detail=f"Gemini API error: {resp.status_code} {resp.text}")
     data = resp.json()
@@ -148,12 +342,445 @@ async def perform_gemini_ocr(img_b64: str, model: str | None = None) -> str:
         {"inlineData": {"mimeType": "image/png", "data": img_b64}},
     ]
     # Run blocking HTTP call in a thread to avoid blocking event loop
-    return await asyncio.to_thread(_gemini_generate, parts, model)
+    return await call_provider("gemini", model or GEMINI_MODEL, lambda: asyncio.to_thread(_gemini_generate, parts, model, _call_timeout(GEMINI_TIMEOUT)))
 
 
 async def perform_gemini_text(prompt: str, model: str | None = None) -> str:
     parts = [{"text": prompt}]
-    return await asyncio.to_thread(_gemini_generate, parts, model)
+    return await call_provider("gemini", model or GEMINI_MODEL, lambda: asyncio.to_thread(_gemini_generate, parts, model, _call_timeout(GEMINI_TIMEOUT)))
+
+
+def provider_label(use_provider: str, model: str | None) -> str:
+    if use_provider == "ollama":
+        return f"ollama:{model or OLLAMA_MODEL}"
+    if use_provider == "gemini":
+        return f"gemini:{model or GEMINI_MODEL}"
+    return "openai:gpt-4o"
+
+
+async def generate_text(use_provider: str, model: str | None, prompt: str, max_tokens: int = 800) -> str:
+    """Single-prompt text generation with the chosen provider."""
+    if use_provider == "ollama":
+        return await perform_ollama_generate(prompt, model or OLLAMA_MODEL)
+    if use_provider == "gemini":
+        return await perform_gemini_text(prompt, model=model or GEMINI_MODEL)
+    response = await call_provider("openai", "gpt-4o", lambda: asyncio.to_thread(
+        get_openai_client().with_options(timeout=_call_timeout(OPENAI_TIMEOUT)).chat.completions.create,
+        model="gpt-4o",
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=max_tokens,
+    ))
+    return response.choices[0].message.content
+
+
+# Embeddings: every text gets an embedding for EMBEDDING_MODEL ("<provider>:<model>"),
+# stored per model in text_embeddings so similarity search always covers the whole space.
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "openai:text-embedding-3-small")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "256"))
+EMBEDDING_BACKFILL_INTERVAL = float(os.getenv("EMBEDDING_BACKFILL_INTERVAL", "300"))  # seconds; 0 disables the loop
+EMBEDDING_BACKFILL_DELAY = float(os.getenv("EMBEDDING_BACKFILL_DELAY", "1.0"))  # pause between batches
+_EMBEDDING_BACKFILL_LOCK_ID = 7201
+_backfill_wakeup = asyncio.Event()
+_backfill_task = None
+
+
+def _split_embedding_model(model_key: str) -> tuple[str, str]:
+    provider, _, name = model_key.partition(":")
+    if not name:
+        return "openai", provider
+    return provider, name
+
+
+async def _embed_chunk(chunk: list[str], provider: str, name: str) -> list[list[float]]:
+    if provider == "ollama":
+        return await call_provider("ollama", name, lambda: asyncio.to_thread(ollama_embeddings, chunk, name, _call_timeout(OLLAMA_TIMEOUT)))
+    resp = await call_provider("openai", name, lambda: asyncio.to_thread(
+        get_openai_client().with_options(timeout=_call_timeout(OPENAI_TIMEOUT)).embeddings.create, model=name, input=chunk
+    ))
+    return [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+
+
+async def embed_texts(texts: list[str], model_key: str = EMBEDDING_MODEL) -> list[list[float]]:
+    """Embed texts with one upstream call per EMBEDDING_BATCH_SIZE inputs."""
+    provider, name = _split_embedding_model(model_key)
+    vectors: list[list[float]] = []
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        chunk = [t if t and t.strip() else " " for t in texts[start:start + EMBEDDING_BATCH_SIZE]]
+        key = request_key("embed", provider, name, *chunk)
+        vectors.extend(await _singleflight.do(key, lambda: _embed_chunk(chunk, provider, name)))
+    return vectors
+
+
+async def _store_embeddings(session, model_key: str, pairs) -> None:
+    rows = [{"text_id": tid, "model": model_key, "dim": len(vec), "embedding": vec} for tid, vec in pairs if vec]
+    if rows:
+        await session.execute(pg_insert(TextEmbedding).values(rows).on_conflict_do_nothing(
+            index_elements=["text_id", "model"]
+        ))
+
+
+async def run_embedding_backfill(model_key: str = EMBEDDING_MODEL) -> dict:
+    """Compute missing embeddings for model_key in batches. Only one worker runs it at a time."""
+    async with engine.connect() as lock_conn:
+        locked = await lock_conn.scalar(sa_text("SELECT pg_try_advisory_lock(:k)"), {"k": _EMBEDDING_BACKFILL_LOCK_ID})
+        if not locked:
+            return {"model": model_key, "skipped": "backfill already running"}
+        try:
+            embedded = 0
+            failed = 0
+            last_id = 0
+            async with SessionLocal() as session:
+                while True:
+                    result = await session.execute(sa_text(
+                        """
+                        SELECT ht.id, ht.text, ht.project_id FROM handwritten_texts ht
+                        WHERE ht.id > :last_id AND length(trim(ht.text)) > 0
+                          AND NOT EXISTS (
+                            SELECT 1 FROM text_embeddings te WHERE te.text_id = ht.id AND te.model = :model
+                          )
+                        ORDER BY ht.id
+                        LIMIT :limit
+                        """
+                    ), {"last_id": last_id, "model": model_key, "limit": EMBEDDING_BATCH_SIZE})
+                    batch = result.fetchall()
+                    if not batch:
+                        break
+                    last_id = batch[-1][0]
+                    try:
+                        vectors = await embed_texts([r[1] for r in batch], model_key)
+                        pairs = list(zip([r[0] for r in batch], vectors))
+                    except ProviderOverloaded as e:
+                        # Provider is saturated; leave the rest for the next run
+                        print("Embedding backfill paused:", e)
+                        break
+                    except Exception as e:
+                        # Isolate bad inputs so one row cannot block the whole batch
+                        print("Embedding backfill batch failed, retrying per row:", e)
+                        pairs = []
+                        for tid, txt, _ in batch:
+                            try:
+                                pairs.append((tid, (await embed_texts([txt], model_key))[0]))
+                            except Exception:
+                                failed += 1
+                    await _store_embeddings(session, model_key, pairs)
+                    await session.commit()
+                    if model_key == EMBEDDING_MODEL:
+                        projects = {r[0]: r[2] for r in batch}
+                        await _vector_index_add([(tid, projects[tid], vec) for tid, vec in pairs])
+                    embedded += len(pairs)
+                    await asyncio.sleep(EMBEDDING_BACKFILL_DELAY)
+                passages, passages_failed = await _backfill_passages(session, model_key)
+            return {"model": model_key, "embedded": embedded, "failed": failed, "passages": passages, "passages_failed": passages_failed}
+        finally:
+            await lock_conn.execute(sa_text("SELECT pg_advisory_unlock(:k)"), {"k": _EMBEDDING_BACKFILL_LOCK_ID})
+
+
+# Shared on-disk embedding index for EMBEDDING_MODEL (see vector_index.py). Every worker maps
+# the same files read-only; new rows and deletions are appended to its log, and the log is
+# folded into a fresh generation once it grows past VECTOR_INDEX_COMPACT_AFTER records.
+VECTOR_INDEX_ENABLED = os.getenv("VECTOR_INDEX_ENABLED", "true").lower() in {"1", "true", "yes"}
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "index")
+VECTOR_INDEX_COMPACT_AFTER = int(os.getenv("VECTOR_INDEX_COMPACT_AFTER", "5000"))
+VECTOR_INDEX_BUILD_BATCH = 2000
+_vector_index = None
+_passage_index = None
+_index_rebuild_tasks: dict[str, asyncio.Task] = {}
+
+
+def _get_vector_index():
+    global _vector_index
+    if _vector_index is None and VECTOR_INDEX_ENABLED:
+        from vector_index import MmapVectorIndex
+        _vector_index = MmapVectorIndex(VECTOR_INDEX_DIR, EMBEDDING_MODEL)
+    return _vector_index
+
+
+def _get_passage_index():
+    """Same on-disk format as the text index, keyed by text_chunks.id, for /projects/{id}/ask."""
+    global _passage_index
+    if _passage_index is None and VECTOR_INDEX_ENABLED:
+        from vector_index import MmapVectorIndex
+        _passage_index = MmapVectorIndex(VECTOR_INDEX_DIR, f"passages:{EMBEDDING_MODEL}")
+    return _passage_index
+
+
+async def _rebuild_index(index, dim_stmt, page_stmt) -> dict:
+    """Write a new index generation from (id, project_id, vector) rows. Only one worker builds at a time.
+    page_stmt(last_id) selects the next batch in ascending id order."""
+    if index is None:
+        return {"skipped": "vector index disabled"}
+    handle = index.try_lock()
+    if handle is None:
+        return {"skipped": "rebuild already running"}
+    try:
+        async with SessionLocal() as session:
+            dim = await session.scalar(dim_stmt)
+            if not dim:
+                return {"skipped": "no embeddings yet"}
+            builder = index.begin_build(dim)
+            last_id = 0
+            while True:
+                rows = (await session.execute(page_stmt(last_id).limit(VECTOR_INDEX_BUILD_BATCH))).all()
+                if not rows:
+                    break
+                await asyncio.to_thread(builder.add, rows)
+                last_id = rows[-1][0]
+            await asyncio.to_thread(builder.finish)
+        return {"generation": builder.gen, "count": builder.count}
+    finally:
+        index.unlock(handle)
+
+
+async def rebuild_vector_index() -> dict:
+    """Write a new text index generation from text_embeddings."""
+    return await _rebuild_index(
+        _get_vector_index(),
+        select(TextEmbedding.dim).where(TextEmbedding.model == EMBEDDING_MODEL).limit(1),
+        lambda last_id: (
+            select(TextEmbedding.text_id, HandwrittenText.project_id, TextEmbedding.embedding)
+            .join(HandwrittenText, HandwrittenText.id == TextEmbedding.text_id)
+            .where(TextEmbedding.model == EMBEDDING_MODEL, TextEmbedding.text_id > last_id)
+            .order_by(TextEmbedding.text_id)
+        ),
+    )
+
+
+async def rebuild_passage_index() -> dict:
+    """Write a new passage index generation from text_chunks."""
+    return await _rebuild_index(
+        _get_passage_index(),
+        select(sa_func.array_length(TextChunk.embedding, 1)).where(TextChunk.model == EMBEDDING_MODEL).limit(1),
+        lambda last_id: (
+            select(TextChunk.id, TextChunk.project_id, TextChunk.embedding)
+            .where(TextChunk.model == EMBEDDING_MODEL, TextChunk.id > last_id)
+            .order_by(TextChunk.id)
+        ),
+    )
+
+
+async def _rebuild_index_logged(rebuild):
+    try:
+        await rebuild()
+    except Exception as e:
+        print(f"{rebuild.__name__} failed:", e)
+
+
+def _schedule_index_rebuild(rebuild):
+    task = _index_rebuild_tasks.get(rebuild.__name__)
+    if task is None or task.done():
+        _index_rebuild_tasks[rebuild.__name__] = asyncio.create_task(_rebuild_index_logged(rebuild))
+
+
+def _schedule_vector_index_rebuild():
+    _schedule_index_rebuild(rebuild_vector_index)
+
+
+def _index_needs_rebuild(index, op: bytes, items) -> bool:
+    # Runs in a worker thread: the append takes the index lock and reads other workers' log records
+    if not index.append(op, items):
+        return True
+    return index.log_records() > VECTOR_INDEX_COMPACT_AFTER or index.build_interrupted()
+
+
+async def _index_append(index, rebuild, op: bytes, items):
+    if index is None or not items:
+        return
+    try:
+        if await asyncio.to_thread(_index_needs_rebuild, index, op, items):
+            _schedule_index_rebuild(rebuild)
+    except Exception as e:
+        print("Vector index append failed:", e)
+
+
+async def _vector_index_add(items):
+    """items: (text_id, project_id, embedding) already committed to the database."""
+    await _index_append(_get_vector_index(), rebuild_vector_index, b"A", items)
+
+
+async def _vector_index_delete(text_ids):
+    await _index_append(_get_vector_index(), rebuild_vector_index, b"D", [(tid, None, None) for tid in text_ids])
+
+
+async def _passage_index_add(items):
+    """items: (chunk_id, project_id, embedding) already committed to the database."""
+    await _index_append(_get_passage_index(), rebuild_passage_index, b"A", items)
+
+
+async def _passage_index_delete(chunk_ids):
+    await _index_append(_get_passage_index(), rebuild_passage_index, b"D", [(cid, None, None) for cid in chunk_ids])
+
+
+def _search_index(index, query_emb, project_id: int | None, limit: int) -> list[tuple[int, float]] | None:
+    """Runs in a worker thread; None while the index has no generation yet."""
+    return index.search(query_emb, project_id, limit) if index.ready else None
+
+
+async def _passage_ids_for_texts(session, text_ids) -> list[int]:
+    """Chunk ids of texts about to be deleted (call before the delete is flushed; chunks cascade)."""
+    if not text_ids:
+        return []
+    return list((await session.scalars(select(TextChunk.id).where(TextChunk.text_id.in_(list(text_ids))))).all())
+
+
+async def _ensure_vector_index():
+    for get_index, rebuild in ((_get_vector_index, rebuild_vector_index), (_get_passage_index, rebuild_passage_index)):
+        index = get_index()
+        if index is None:
+            continue
+        # Also rebuild when an earlier build died between begin_build and finish
+        if not await asyncio.to_thread(lambda: index.ready and not index.build_interrupted()):
+            await _rebuild_index_logged(rebuild)
+
+
+# Passage index: each text is split into overlapping passages embedded with EMBEDDING_MODEL,
+# so questions about a project retrieve a few passages instead of sending the whole corpus.
+PASSAGE_MAX_CHARS = int(os.getenv("PASSAGE_MAX_CHARS", "800"))
+_background_tasks: set = set()
+
+
+def _spawn(coro):
+    """Fire-and-forget task that is kept referenced until it finishes (and not bound by the request deadline)."""
+    token = current_deadline.set(None)
+    try:
+        task = asyncio.create_task(coro)
+    finally:
+        current_deadline.reset(token)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def _index_passages(session, items, model_key: str = EMBEDDING_MODEL) -> list[tuple[int, int | None, list[float]]]:
+    """Split, embed (batched) and store passages for (text_id, project_id, text) items; caller commits.
+    Returns (chunk_id, project_id, embedding) of the new rows for the passage index."""
+    passages = []
+    for text_id, project_id, text in items:
+        for idx, content in enumerate(split_into_passages(text, PASSAGE_MAX_CHARS)):
+            passages.append((text_id, project_id, idx, content))
+    if not passages:
+        return []
+    vectors = await embed_texts([p[3] for p in passages], model_key)
+    rows = [
+        {"text_id": tid, "project_id": pid, "model": model_key, "chunk_index": idx, "content": content, "embedding": vec}
+        for (tid, pid, idx, content), vec in zip(passages, vectors) if vec
+    ]
+    # Large projects can produce many rows; keep each INSERT's parameter count bounded
+    inserted = []
+    for start in range(0, len(rows), 500):
+        result = await session.execute(pg_insert(TextChunk).values(rows[start:start + 500]).on_conflict_do_nothing(
+            index_elements=["text_id", "model", "chunk_index"]
+        ).returning(TextChunk.id, TextChunk.project_id, TextChunk.embedding))
+        inserted.extend(tuple(r) for r in result.all())
+    return inserted
+
+
+async def _index_passages_background(text_id: int, project_id: int | None, text: str):
+    try:
+        async with SessionLocal() as session:
+            inserted = await _index_passages(session, [(text_id, project_id, text)])
+            await session.commit()
+        await _passage_index_add(inserted)
+    except Exception as e:
+        # The backfill loop retries texts without passages
+        print("Passage indexing failed for text", text_id, ":", e)
+
+
+async def _backfill_passages(session, model_key: str) -> tuple[int, int]:
+    chunked = 0
+    failed = 0
+    last_id = 0
+    while True:
+        result = await session.execute(sa_text(
+            """
+            SELECT ht.id, ht.project_id, ht.text FROM handwritten_texts ht
+            WHERE ht.id > :last_id AND length(trim(ht.text)) > 0
+              AND NOT EXISTS (
+                SELECT 1 FROM text_chunks tc WHERE tc.text_id = ht.id AND tc.model = :model
+              )
+            ORDER BY ht.id
+            LIMIT :limit
+            """
+        ), {"last_id": last_id, "model": model_key, "limit": 32})
+        batch = result.fetchall()
+        if not batch:
+            break
+        last_id = batch[-1][0]
+        try:
+            inserted = await _index_passages(session, [tuple(r) for r in batch], model_key)
+            await session.commit()
+            chunked += len(inserted)
+            if model_key == EMBEDDING_MODEL:
+                await _passage_index_add(inserted)
+        except ProviderOverloaded as e:
+            print("Passage backfill paused:", e)
+            await session.rollback()
+            break
+        except Exception as e:
+            print("Passage backfill batch failed:", e)
+            await session.rollback()
+            failed += len(batch)
+        await asyncio.sleep(EMBEDDING_BACKFILL_DELAY)
+    return chunked, failed
+
+
+async def _embedding_backfill_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_backfill_wakeup.wait(), timeout=EMBEDDING_BACKFILL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _backfill_wakeup.clear()
+        try:
+            await run_embedding_backfill()
+        except Exception as e:
+            print("Embedding backfill failed:", e)
+
+
+# Derived text columns (utils.text_features) for rows stored before migration 7. Filled after
+# startup in small, separately committed batches, so no replica waits for it and no long
+# transaction holds row locks; one worker at a time via an advisory lock.
+TEXT_FEATURES_BATCH_SIZE = int(os.getenv("TEXT_FEATURES_BATCH_SIZE", "500"))
+_TEXT_FEATURES_LOCK_ID = 7202
+
+
+async def run_text_features_backfill() -> dict:
+    async with engine.connect() as lock_conn:
+        locked = await lock_conn.scalar(sa_text("SELECT pg_try_advisory_lock(:k)"), {"k": _TEXT_FEATURES_LOCK_ID})
+        if not locked:
+            return {"skipped": "backfill already running"}
+        try:
+            updated = 0
+            last_id = 0
+            while True:
+                async with SessionLocal() as session:
+                    rows = (await session.execute(sa_text(
+                        "SELECT id, text FROM handwritten_texts WHERE id > :last_id AND content_hash IS NULL ORDER BY id LIMIT :limit"
+                    ), {"last_id": last_id, "limit": TEXT_FEATURES_BATCH_SIZE})).all()
+                    if not rows:
+                        break
+                    last_id = rows[-1][0]
+                    # Language detection is CPU-bound; keep it off the event loop
+                    params = await asyncio.to_thread(lambda: [{"id": r[0], **text_features(r[1])} for r in rows])
+                    await session.execute(sa_text(
+                        "UPDATE handwritten_texts SET char_count = :char_count, word_count = :word_count, "
+                        "normalized_text = :normalized_text, language = :language, content_hash = :content_hash "
+                        "WHERE id = :id AND content_hash IS NULL"
+                    ), params)
+                    await session.commit()
+                updated += len(rows)
+                await asyncio.sleep(EMBEDDING_BACKFILL_DELAY)
+            return {"updated": updated}
+        finally:
+            await lock_conn.execute(sa_text("SELECT pg_advisory_unlock(:k)"), {"k": _TEXT_FEATURES_LOCK_ID})
+
+
+async def _text_features_backfill_logged():
+    try:
+        result = await run_text_features_backfill()
+        if result.get("updated"):
+            print("Text features backfilled:", result["updated"])
+    except Exception as e:
+        print("Text features backfill failed:", e)
 
 
 # Project endpoints
@@ -174,14 +801,68 @@ async def create_project(body: CreateProjectRequest):
         await session.refresh(proj)
         return {"id": proj.id, "name": proj.name, "description": proj.description, "created_at": proj.created_at.isoformat()}
 
+# List endpoints send an ETag derived from a fingerprint of the rows they cover: a hash over
+# each row's id and xmin. Postgres gives every inserted or updated row version a new xmin, so
+# inserts, deletes and in-place edits (e.g. via /texts/raw_query) all change it. Only id and
+# the system column are read; the text itself is not touched. The tag is weak because the same
+# value goes out with identity, gzip and Brotli bodies, which are not byte-identical.
+def _make_etag(*parts) -> str:
+    return 'W/"' + hashlib.sha1(json.dumps(parts, default=str).encode("utf-8")).hexdigest() + '"'
+
+
+def _not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return etag.removeprefix("W/") in tags or "*" in tags
+
+
+def _etag_response(request: Request, etag: str, build):
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return FastJSONResponse(build(), headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+_FINGERPRINT_SQL = "SELECT md5(string_agg(id::text || ':' || xmin::text, ',' ORDER BY id)) FROM {table}"
+
+
+async def _texts_fingerprint(session, project_id: int | None):
+    if project_id is None:
+        return await session.scalar(sa_text(_FINGERPRINT_SQL.format(table="handwritten_texts")))
+    return await session.scalar(
+        sa_text(_FINGERPRINT_SQL.format(table="handwritten_texts") + " WHERE project_id = :pid"), {"pid": project_id}
+    )
+
+
+# Columns needed to render a text in list responses (skips the embedding array)
+_TEXT_COLUMNS = (
+    HandwrittenText.id, HandwrittenText.name, HandwrittenText.filename, HandwrittenText.text,
+    HandwrittenText.created_at, HandwrittenText.project_id,
+)
+
+
+def _text_row(i, uploads_prefix: str) -> dict:
+    return {"id": i.id, "name": i.name, "filename": i.filename, "image_url": (uploads_prefix + i.filename if i.filename else None), "text": i.text, "created_at": i.created_at.isoformat(), "project_id": i.project_id}
+
+
+def _uploads_prefix(request: Request) -> str:
+    return f"{str(request.base_url).rstrip('/')}/uploads/"
+
+
 @app.get("/projects/")
-async def list_projects():
-    async with SessionLocal() as session:
+async def list_projects(request: Request):
+    async with ReadSessionLocal() as session:
+        fingerprint = await session.scalar(sa_text(_FINGERPRINT_SQL.format(table="projects")))
+        etag = _make_etag("projects", fingerprint)
+        if _not_modified(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
         result = await session.execute(select(Project).order_by(Project.created_at.desc()))
         items = result.scalars().all()
-        return [
+        return _etag_response(request, etag, lambda: [
             {"id": p.id, "name": p.name, "description": p.description, "created_at": p.created_at.isoformat()} for p in items
-        ]
+        ])
 
 @app.get("/projects/{project_id}")
 async def get_project(project_id: int):
@@ -193,14 +874,228 @@ async def get_project(project_id: int):
         return {"id": proj.id, "name": proj.name, "description": proj.description, "created_at": proj.created_at.isoformat()}
 
 
+# Minimum budget (seconds) a fallback stage needs before it is worth starting under a deadline
+OCR_LLM_MIN_SECONDS = float(os.getenv("OCR_LLM_MIN_SECONDS", "3"))
+OCR_TESSERACT_MIN_SECONDS = float(os.getenv("OCR_TESSERACT_MIN_SECONDS", "1"))
+OCR_EMBED_MIN_SECONDS = float(os.getenv("OCR_EMBED_MIN_SECONDS", "1"))
+TESSERACT_TIMEOUT = float(os.getenv("TESSERACT_TIMEOUT", "30"))
+
+
+async def _extract_text(original_image, img_base64: str, use_provider: str, model: str | None, processed=None, tesseract_text: str | None = None) -> tuple[str, str | None, list[str]]:
+    """
+    Run the provider OCR chain with its refusal fallbacks; returns (text, provider used, skipped stages).
+    Under a request deadline, stages that cannot finish in the remaining budget are skipped (or cut off)
+    and the chain moves on, ending with whatever Tesseract can read or an empty string.
+    tesseract_text is a Tesseract result already computed by the caller, used instead of running it again.
+    """
+    deadline = current_deadline.get()
+    skipped: list[str] = []
+
+    def preprocessed():
+        nonlocal processed
+        if processed is None:
+            processed = preprocess_image_for_ocr(original_image)
+        return processed
+
+    if use_provider == "ollama":
+        ollama_model = model or OLLAMA_MODEL
+        prompt = "Extract all text from this image (Base64 PNG). Return only the transcribed text, no explanations.\n" + img_base64
+        # Retry with stronger instruction
+        retry_prompt = (
+            "You must transcribe any readable text from this image (Base64 PNG). "
+            "If no text is present, return an empty string. Return only the text.\n" + img_base64
+        )
+        stages = [
+            ("ollama", lambda: perform_ollama_generate(prompt, ollama_model)),
+            ("ollama", lambda: perform_ollama_generate(retry_prompt, ollama_model)),
+            # Preprocess and retry via OpenAI if available, else fall back to tesseract
+            ("openai+preprocess", lambda: perform_openai_ocr(pil_image_to_base64_png(preprocessed()))),
+        ]
+    elif use_provider == "gemini":
+        gemini_model = model or GEMINI_MODEL
+        stages = [
+            (f"gemini:{gemini_model}", lambda: perform_gemini_ocr(img_base64, model=gemini_model)),
+            (f"gemini:{gemini_model}+preprocess", lambda: perform_gemini_ocr(pil_image_to_base64_png(preprocessed()), model=gemini_model)),
+        ]
+    else:
+        # OpenAI primary, then preprocess and retry
+        stages = [
+            ("openai", lambda: perform_openai_ocr(img_base64)),
+            ("openai+preprocess", lambda: perform_openai_ocr(pil_image_to_base64_png(preprocessed()))),
+        ]
+
+    for label, call in stages:
+        if deadline is not None and not deadline.allows(OCR_LLM_MIN_SECONDS):
+            skipped.append(label)
+            continue
+        try:
+            text = await call()
+        except DeadlineExceeded:
+            skipped.append(label)
+            continue
+        if not is_refusal(text):
+            return text or "", label, skipped
+
+    # Tesseract fallback
+    if tesseract_text is not None:
+        return tesseract_text, "tesseract", skipped
+    if deadline is not None and not deadline.allows(OCR_TESSERACT_MIN_SECONDS):
+        skipped.append("tesseract")
+        return "", None, skipped
+    timeout = TESSERACT_TIMEOUT if deadline is None else min(TESSERACT_TIMEOUT, deadline.remaining())
+    try:
+        text = await asyncio.to_thread(tesseract_image_to_string, preprocessed(), timeout)
+    except RuntimeError as e:
+        # pytesseract kills the process on timeout; TesseractError (also a RuntimeError) still propagates
+        if "timeout" not in str(e).lower():
+            raise
+        print("Tesseract did not finish:", e)
+        skipped.append("tesseract")
+        return "", None, skipped
+    return text or "", "tesseract", skipped
+
+
+# OCR routing: 'llm' sends every image to the provider chain (Tesseract is the last resort);
+# 'tesseract_first' runs Tesseract with per-word confidences and escalates to the chain only when
+# the mean confidence, word count or text density (fraction of the image covered by word boxes)
+# is below its threshold. The answering tier is stored with the text (see /analytics/ocr_tiers).
+OCR_ROUTING = os.getenv("OCR_ROUTING", "llm").lower()
+OCR_ROUTING_MODES = {"llm", "tesseract_first"}
+OCR_TESSERACT_MIN_CONFIDENCE = float(os.getenv("OCR_TESSERACT_MIN_CONFIDENCE", "80"))
+OCR_TESSERACT_MIN_WORDS = int(os.getenv("OCR_TESSERACT_MIN_WORDS", "3"))
+OCR_TESSERACT_MIN_DENSITY = float(os.getenv("OCR_TESSERACT_MIN_DENSITY", "0.01"))
+
+
+def _ocr_tier(provider_used: str | None) -> str | None:
+    """Tier that answered; None when no stage produced text."""
+    if provider_used is None:
+        return None
+    return "tesseract" if provider_used == "tesseract" else "llm"
+
+
+async def _route_ocr(original_image, img_base64: str, use_provider: str, model: str | None, routing: str):
+    """OCR through the routing tiers; returns (text, provider used, skipped stages, tier, routing details)."""
+    if routing != "tesseract_first":
+        text, used, skipped = await _extract_text(original_image, img_base64, use_provider, model)
+        return text, used, skipped, _ocr_tier(used), {"mode": routing}
+
+    deadline = current_deadline.get()
+    processed = preprocess_image_for_ocr(original_image)
+    details = {"mode": routing, "confidence": None, "words": None, "density": None, "escalated": True, "reasons": []}
+    result = None
+    if deadline is None or deadline.allows(OCR_TESSERACT_MIN_SECONDS):
+        timeout = TESSERACT_TIMEOUT if deadline is None else min(TESSERACT_TIMEOUT, deadline.remaining())
+        try:
+            result = await asyncio.to_thread(tesseract_image_to_data, processed, timeout)
+        except Exception as e:
+            # Any Tesseract failure (timeout, missing binary, bad image) just means escalating
+            details["reasons"].append(f"tesseract failed: {e}")
+    else:
+        details["reasons"].append("no budget for tesseract")
+
+    if result is not None:
+        details.update(confidence=round(result["mean_confidence"], 1), words=result["words"], density=round(result["density"], 4))
+        if result["mean_confidence"] < OCR_TESSERACT_MIN_CONFIDENCE:
+            details["reasons"].append(f"confidence {result['mean_confidence']:.1f} < {OCR_TESSERACT_MIN_CONFIDENCE:g}")
+        if result["words"] < OCR_TESSERACT_MIN_WORDS:
+            details["reasons"].append(f"words {result['words']} < {OCR_TESSERACT_MIN_WORDS}")
+        if result["density"] < OCR_TESSERACT_MIN_DENSITY:
+            details["reasons"].append(f"density {result['density']:.4f} < {OCR_TESSERACT_MIN_DENSITY:g}")
+        if not details["reasons"]:
+            details["escalated"] = False
+            return result["text"], "tesseract", [], "tesseract", details
+
+    # Escalate; if every provider stage refuses or is skipped, the Tesseract read is still the answer
+    text, used, skipped = await _extract_text(
+        original_image, img_base64, use_provider, model,
+        processed=processed, tesseract_text=result["text"] if result is not None else None,
+    )
+    return text, used, skipped, _ocr_tier(used), details
+
+
+# Perceptual-hash near-duplicate detection: one in-memory BK-tree per project, built lazily
+# from the phash column. dedupe mode "flag" reports the match, "reuse" also skips OCR.
+PHASH_THRESHOLD = int(os.getenv("PHASH_THRESHOLD", "6"))  # max Hamming distance out of 64 bits
+PHASH_DEDUPE_MODE = os.getenv("PHASH_DEDUPE_MODE", "flag")  # 'off' | 'flag' | 'reuse'
+PHASH_DEDUPE_MODES = {"off", "flag", "reuse"}
+# Per project: (tree, ids already in it, highest id seen). Each worker tops its tree up from the
+# database before every search, so uploads handled by other workers are seen too. Ids are assigned
+# before commit, so the top-up re-reads an overlap window below the highest id seen.
+_phash_indexes: dict[int | None, tuple[BKTree, set[int], int]] = {}
+_phash_index_locks: dict[int | None, asyncio.Lock] = {}  # one per project, so refreshes only queue up per project
+_PHASH_REFRESH_OVERLAP = 1000
+
+
+def _to_signed64(value: int) -> int:
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _to_unsigned64(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+async def _get_phash_index(project_id: int | None) -> BKTree:
+    async with _phash_index_locks.setdefault(project_id, asyncio.Lock()):
+        tree, seen, max_id = _phash_indexes.get(project_id) or (BKTree(), set(), 0)
+        async with ReadSessionLocal() as session:
+            await _apply_statement_timeout(session)
+            stmt = select(HandwrittenText.id, HandwrittenText.phash).where(
+                HandwrittenText.phash.isnot(None), HandwrittenText.id > max_id - _PHASH_REFRESH_OVERLAP
+            )
+            if project_id is None:
+                stmt = stmt.where(HandwrittenText.project_id.is_(None))
+            else:
+                stmt = stmt.where(HandwrittenText.project_id == project_id)
+            for tid, h in (await session.execute(stmt)).all():
+                if tid not in seen:
+                    seen.add(tid)
+                    tree.add(_to_unsigned64(h), tid)
+                    max_id = max(max_id, tid)
+        _phash_indexes[project_id] = (tree, seen, max_id)
+        return tree
+
+
+async def _find_near_duplicate(project_id: int | None, image_hash: int):
+    """Closest surviving text within PHASH_THRESHOLD, as (HandwrittenText, distance) or (None, None)."""
+    tree = await _get_phash_index(project_id)
+    matches = tree.search(image_hash, PHASH_THRESHOLD)
+    if not matches:
+        return None, None
+    async with ReadSessionLocal() as session:
+        await _apply_statement_timeout(session)
+        # Deleted texts stay in the tree; skip ids that no longer exist
+        items = await _fetch_texts_by_id(session, [tid for _, tid in matches])
+    for distance, tid in matches:
+        if tid in items:
+            return items[tid], distance
+    return None, None
+
+
+async def _get_stored_embedding(text_id: int):
+    async with ReadSessionLocal() as session:
+        await _apply_statement_timeout(session)
+        return await session.scalar(
+            select(TextEmbedding.embedding).where(TextEmbedding.text_id == text_id, TextEmbedding.model == EMBEDDING_MODEL)
+        )
+
+
 @app.post("/ocr/")
-async def ocr_image(request: Request, file: UploadFile = File(...), provider: str = None, model: str = None, project_id: int | None = None, name: str | None = None):
+async def ocr_image(request: Request, file: UploadFile = File(...), provider: str = None, model: str = None, project_id: int | None = None, name: str | None = None, dedupe: str | None = None, timeout_ms: int | None = None, routing: str | None = None):
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image.")
+    routing = (routing or OCR_ROUTING).lower()
+    if routing not in OCR_ROUTING_MODES:
+        raise HTTPException(status_code=400, detail=f"routing must be one of: {', '.join(sorted(OCR_ROUTING_MODES))}")
+    dedupe_mode = (dedupe or PHASH_DEDUPE_MODE).lower()
+    if dedupe_mode not in PHASH_DEDUPE_MODES:
+        raise HTTPException(status_code=400, detail=f"dedupe must be one of: {', '.join(sorted(PHASH_DEDUPE_MODES))}")
+    deadline = _request_deadline(request, timeout_ms)
+    deadline_token = current_deadline.set(deadline)
+    saved_path = None
     try:
         # Read uploaded bytes and create Pillow image from bytes
         content = await file.read()
-        original_image = Image.open(io.BytesIO(content))
+        original_image = open_image(io.BytesIO(content))
         img_base64 = pil_image_to_base64_png(original_image)
 
         # Save original uploaded file to uploads directory with a safe unique name
@@ -212,129 +1107,156 @@ async def ocr_image(request: Request, file: UploadFile = File(...), provider: st
         with open(saved_path, "wb") as f:
             f.write(content)
 
-        use_provider = provider or DEFAULT_PROVIDER
-        extracted_text = None
-        final_provider_used = None
-
-        if use_provider == "ollama":
-            ollama_model = model or OLLAMA_MODEL
-            prompt = "Extract all text from this image (Base64 PNG). Return only the transcribed text, no explanations.\n" + img_base64
-            text = ollama_generate(prompt, model=ollama_model)
-            if is_refusal(text):
-                # Retry with stronger instruction
-                retry_prompt = (
-                    "You must transcribe any readable text from this image (Base64 PNG). "
-                    "If no text is present, return an empty string. Return only the text.\n" + img_base64
-                )
-                text = ollama_generate(retry_prompt, model=ollama_model)
-            if is_refusal(text):
-                # Preprocess and retry via OpenAI if available, else fall back to tesseract
-                processed = preprocess_image_for_ocr(original_image)
-                processed_b64 = pil_image_to_base64_png(processed)
-                text_openai = await perform_openai_ocr(processed_b64)
-                if not is_refusal(text_openai):
-                    extracted_text = text_openai
-                    final_provider_used = "openai+preprocess"
-                else:
-                    # Tesseract fallback
-                    extracted_text = pytesseract.image_to_string(processed)
-                    final_provider_used = "tesseract"
-            else:
-                extracted_text = text
-                final_provider_used = "ollama"
-        elif use_provider == "gemini":
-            gemini_model = model or GEMINI_MODEL
-            text = await perform_gemini_ocr(img_base64, model=gemini_model)
-            if is_refusal(text):
-                processed = preprocess_image_for_ocr(original_image)
-                processed_b64 = pil_image_to_base64_png(processed)
-                text_retry = await perform_gemini_ocr(processed_b64, model=gemini_model)
-                if is_refusal(text_retry):
-                    # Tesseract fallback
-                    extracted_text = pytesseract.image_to_string(processed)
-                    final_provider_used = "tesseract"
-                else:
-                    extracted_text = text_retry
-                    final_provider_used = f"gemini:{gemini_model}+preprocess"
-            else:
-                extracted_text = text
-                final_provider_used = f"gemini:{gemini_model}"
+        # Near-duplicate check against earlier uploads in the same project
+        image_hash = perceptual_hash(original_image)
+        duplicate = None
+        duplicate_item = None
+        skipped: list[str] = []
+        if dedupe_mode in {"flag", "reuse"}:
+            try:
+                duplicate_item, distance = await _find_near_duplicate(project_id, image_hash)
+            except Exception as e:
+                if not (isinstance(e, DeadlineExceeded) or _is_statement_timeout(e)):
+                    raise
+                skipped.append("dedupe")
+            if duplicate_item is not None:
+                duplicate = {"match_id": duplicate_item.id, "distance": distance, "threshold": PHASH_THRESHOLD, "action": "reused" if dedupe_mode == "reuse" else "flagged"}
+
+        embedding = None
+        routing_info = {"mode": routing}
+        if duplicate_item is not None and dedupe_mode == "reuse":
+            extracted_text = duplicate_item.text
+            final_provider_used = f"duplicate:{duplicate_item.id}"
+            tier = "duplicate"
+            try:
+                embedding = await _get_stored_embedding(duplicate_item.id)
+            except Exception as e:
+                if not (isinstance(e, DeadlineExceeded) or _is_statement_timeout(e)):
+                    raise
         else:
-            # OpenAI primary
-            text = await perform_openai_ocr(img_base64)
-            if is_refusal(text):
-                # Preprocess and retry
-                processed = preprocess_image_for_ocr(original_image)
-                processed_b64 = pil_image_to_base64_png(processed)
-                text_retry = await perform_openai_ocr(processed_b64)
-                if is_refusal(text_retry):
-                    # Tesseract fallback
-                    extracted_text = pytesseract.image_to_string(processed)
-                    final_provider_used = "tesseract"
-                else:
-                    extracted_text = text_retry
-                    final_provider_used = "openai+preprocess"
-            else:
-                extracted_text = text
-                final_provider_used = "openai"
+            use_provider = provider or DEFAULT_PROVIDER
+            # Identical concurrent uploads (same bytes, provider, model, routing) share one provider chain,
+            # which runs under the deadline of the request that started it
+            ocr_key = request_key("ocr", use_provider, model or "", routing, content)
+            try:
+                extracted_text, final_provider_used, ocr_skipped, tier, routing_info = await asyncio.wait_for(_singleflight.do(
+                    ocr_key, lambda: _route_ocr(original_image, img_base64, use_provider, model, routing)
+                ), timeout=deadline.remaining())
+            except asyncio.TimeoutError:
+                extracted_text, final_provider_used, ocr_skipped, tier = "", None, ["ocr (shared in-flight request)"], None
+            skipped += ocr_skipped  # copied: the result may be shared with coalesced callers
 
-        # Ensure we have a string (avoid None)
-        if extracted_text is None:
-            extracted_text = ""
+        if final_provider_used is None:
+            # Nothing could be read within the budget: keep no row or upload, report what was skipped
+            saved_path.unlink(missing_ok=True)
+            return JSONResponse(status_code=504, content={
+                "error": "deadline exceeded before any OCR stage produced text",
+                "text": "", "provider": None, "tier": None, "routing": routing_info, "duplicate": duplicate,
+                "deadline": {
+                    "budget_ms": round(deadline.budget * 1000),
+                    "elapsed_ms": round(deadline.elapsed() * 1000),
+                    "skipped": skipped,
+                    "partial": True,
+                    "reason": f"deadline: skipped {', '.join(skipped)}",
+                },
+            })
 
-        # Generate embedding (skip if completely empty)
-        if final_provider_used.startswith("ollama"):
-            emb_model = model or OLLAMA_MODEL
-            embedding = ollama_embedding(extracted_text, model=emb_model) if extracted_text.strip() else None
-        else:
-            emb_response = client.embeddings.create(
-                model="text-embedding-3-small",
-                input=extracted_text or " "
-            )
-            embedding = emb_response.data[0].embedding if extracted_text.strip() else None
+        # Generate embedding with the shared embedding model (skip if completely empty).
+        # On failure, or without budget left, the row is stored without one and the backfill picks it up later.
+        if embedding is None and extracted_text.strip():
+            if deadline.allows(OCR_EMBED_MIN_SECONDS):
+                try:
+                    embedding = (await embed_texts([extracted_text]))[0]
+                except Exception as e:
+                    print("Embedding failed in /ocr/, deferring to backfill:", e)
+            else:
+                skipped.append("embedding")
+
+        # Derived columns (counts, normalised text, language, content hash) are computed once here
+        features = await asyncio.to_thread(text_features, extracted_text)
 
-        # Save to DB (store the saved filename so we can serve the image later)
+        # Save to DB (store the saved filename so we can serve the image later). The save gets at
+        # least DEADLINE_DB_MIN_MS so a result that used up the budget is not thrown away.
         async with SessionLocal() as session:
+            await _apply_statement_timeout(session, DEADLINE_DB_MIN_MS)
             db_obj = HandwrittenText(
                 name=name,
                 filename=saved_name,
                 text=extracted_text,
-                embedding=embedding,
-                project_id=project_id
+                project_id=project_id,
+                phash=_to_signed64(image_hash),
+                ocr_tier=tier,
+                ocr_provider=final_provider_used,
+                ocr_confidence=routing_info.get("confidence"),
+                **features,
             )
             session.add(db_obj)
+            await session.flush()
+            if embedding:
+                await _store_embeddings(session, EMBEDDING_MODEL, [(db_obj.id, embedding)])
+            await _invalidate_summaries(session, project_ids=[project_id])
             await session.commit()
+        if embedding:
+            await _vector_index_add([(db_obj.id, project_id, embedding)])
+        if extracted_text.strip():
+            _spawn(_index_passages_background(db_obj.id, project_id, extracted_text))
+        if extracted_text.strip() and not embedding:
+            _backfill_wakeup.set()
 
         image_url = f"{str(request.base_url).rstrip('/')}/uploads/{saved_name}"
-        return {"text": extracted_text, "provider": final_provider_used, "project_id": project_id, "name": name, "saved_filename": saved_name, "image_url": image_url}
+        partial = any(stage not in {"embedding", "dedupe"} for stage in skipped)
+        deadline_info = {
+            "budget_ms": round(deadline.budget * 1000),
+            "elapsed_ms": round(deadline.elapsed() * 1000),
+            "skipped": skipped,
+            "partial": partial,
+            "reason": f"deadline: skipped {', '.join(skipped)}" if skipped else None,
+        }
+        return {"text": extracted_text, "provider": final_provider_used, "project_id": project_id, "name": name, "saved_filename": saved_name, "image_url": image_url, "duplicate": duplicate, "tier": tier, "routing": routing_info, "deadline": deadline_info}
+    except (ProviderOverloaded, DeadlineExceeded):
+        # Shed before anything was stored (both are only raised ahead of the DB save): drop the upload too
+        if saved_path is not None:
+            saved_path.unlink(missing_ok=True)
+        raise
     except Exception as e:
         print("Exception in /ocr/:", e)
         traceback.print_exc()
         return JSONResponse(status_code=500, content={"error": str(e)})
+    finally:
+        current_deadline.reset(deadline_token)
 
 @app.get("/texts/")
 async def get_texts(request: Request, project_id: int | None = None):
-    async with SessionLocal() as session:
-        stmt = select(HandwrittenText).order_by(HandwrittenText.created_at.desc())
+    uploads_prefix = _uploads_prefix(request)
+    async with ReadSessionLocal() as session:
+        etag = _make_etag("texts", project_id, uploads_prefix, await _texts_fingerprint(session, project_id))
+        if _not_modified(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        stmt = select(*_TEXT_COLUMNS).order_by(HandwrittenText.created_at.desc())
         if project_id is not None:
             stmt = stmt.where(HandwrittenText.project_id == project_id)
         result = await session.execute(stmt)
-        items = result.scalars().all()
-        return [
-            {"id": i.id, "name": i.name, "filename": i.filename, "image_url": (f"{str(request.base_url).rstrip('/')}/uploads/{i.filename}" if i.filename else None), "text": i.text, "created_at": i.created_at.isoformat(), "project_id": i.project_id} for i in items
-        ]
+        items = result.all()
+        return _etag_response(request, etag, lambda: [_text_row(i, uploads_prefix) for i in items])
 
 @app.get("/texts/search")
 async def search_texts(request: Request, q: str = Query(..., min_length=1), project_id: int | None = None):
-    async with SessionLocal() as session:
-        stmt = select(HandwrittenText).where(HandwrittenText.text.ilike(f"%{q}%")).order_by(HandwrittenText.created_at.desc())
+    uploads_prefix = _uploads_prefix(request)
+    async with ReadSessionLocal() as session:
+        etag = _make_etag("search", q, project_id, uploads_prefix, await _texts_fingerprint(session, project_id))
+        if _not_modified(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        # normalized_text is stored case-folded at ingest and trigram-indexed; rows the
+        # background backfill has not reached yet are matched on the raw text
+        stmt = select(*_TEXT_COLUMNS).where(or_(
+            HandwrittenText.normalized_text.like(f"%{normalize_text(q)}%"),
+            and_(HandwrittenText.normalized_text.is_(None), HandwrittenText.text.ilike(f"%{q}%")),
+        )).order_by(HandwrittenText.created_at.desc())
         if project_id is not None:
             stmt = stmt.where(HandwrittenText.project_id == project_id)
         result = await session.execute(stmt)
-        items = result.scalars().all()
-        return [
-            {"id": i.id, "name": i.name, "filename": i.filename, "image_url": (f"{str(request.base_url).rstrip('/')}/uploads/{i.filename}" if i.filename else None), "text": i.text, "created_at": i.created_at.isoformat(), "project_id": i.project_id} for i in items
-        ]
+        items = result.all()
+        return _etag_response(request, etag, lambda: [_text_row(i, uploads_prefix) for i in items])
 
 @app.delete("/texts/{text_id}")
 async def delete_text(text_id: int):
@@ -346,10 +1268,14 @@ async def delete_text(text_id: int):
         
         if not text:
             raise HTTPException(status_code=404, detail="Text not found")
+        chunk_ids = await _passage_ids_for_texts(session, [text_id])
         
         # Delete the text
         await session.delete(text)
+        await _invalidate_summaries(session, project_ids=[text.project_id], text_ids=[text_id])
         await session.commit()
+        await _vector_index_delete([text_id])
+        await _passage_index_delete(chunk_ids)
         
         return {"message": "Text deleted successfully", "deleted_id": text_id}
 
@@ -368,11 +1294,15 @@ async def clear_project_content(project_id: int):
         stmt = select(HandwrittenText).where(HandwrittenText.project_id == project_id)
         result = await session.execute(stmt)
         texts = result.scalars().all()
+        chunk_ids = await _passage_ids_for_texts(session, [t.id for t in texts])
         
         for text in texts:
             await session.delete(text)
         
+        await _invalidate_summaries(session, project_ids=[project_id], text_ids=[t.id for t in texts])
         await session.commit()
+        await _vector_index_delete([t.id for t in texts])
+        await _passage_index_delete(chunk_ids)
         
         return {"message": f"Cleared {len(texts)} texts from project '{project.name}'", "project_id": project_id, "deleted_count": len(texts)}
 
@@ -391,13 +1321,17 @@ async def delete_project(project_id: int):
         stmt = select(HandwrittenText).where(HandwrittenText.project_id == project_id)
         result = await session.execute(stmt)
         texts = result.scalars().all()
+        chunk_ids = await _passage_ids_for_texts(session, [t.id for t in texts])
         
         for text in texts:
             await session.delete(text)
         
         # Delete the project
         await session.delete(project)
+        await _invalidate_summaries(session, project_ids=[project_id], text_ids=[t.id for t in texts])
         await session.commit()
+        await _vector_index_delete([t.id for t in texts])
+        await _passage_index_delete(chunk_ids)
         
         return {"message": f"Deleted project '{project.name}' and {len(texts)} associated texts", "deleted_project_id": project_id, "deleted_texts_count": len(texts)}
 
@@ -409,6 +1343,9 @@ async def bulk_delete_texts(request: BulkDeleteRequest):
     async with SessionLocal() as session:
         deleted_count = 0
         failed_ids = []
+        deleted_texts = []
+        # Collected before any delete is flushed, since chunks go with their text
+        chunk_ids = await _passage_ids_for_texts(session, request.text_ids)
         
         for text_id in request.text_ids:
             try:
@@ -418,13 +1355,17 @@ async def bulk_delete_texts(request: BulkDeleteRequest):
                 
                 if text:
                     await session.delete(text)
+                    deleted_texts.append(text)
                     deleted_count += 1
                 else:
                     failed_ids.append(text_id)
             except Exception as e:
                 failed_ids.append(text_id)
         
+        await _invalidate_summaries(session, project_ids=[t.project_id for t in deleted_texts], text_ids=[t.id for t in deleted_texts])
         await session.commit()
+        await _vector_index_delete([t.id for t in deleted_texts])
+        await _passage_index_delete(chunk_ids)
         
         return {
             "message": f"Deleted {deleted_count} texts successfully",
@@ -438,62 +1379,218 @@ class SimilarityQuery(BaseModel):
 
 @app.post("/texts/similarity")
 async def similarity_search(body: SimilarityQuery):
+    import numpy as np
     query = body.query
     # Generate embedding for query
-    emb_response = client.embeddings.create(
-        model="text-embedding-3-small",
-        input=query
-    )
-    query_emb = np.array(emb_response.data[0].embedding)
-    # Fetch all embeddings from DB
-    async with SessionLocal() as session:
-        stmt = select(HandwrittenText)
-        if body.project_id is not None:
-            stmt = stmt.where(HandwrittenText.project_id == body.project_id)
-        result = await session.execute(stmt)
-        items = result.scalars().all()
-        scored = []
-        for i in items:
-            if i.embedding and len(i.embedding) == len(query_emb):
-                emb = np.array(i.embedding)
-                sim = float(np.dot(query_emb, emb) / (np.linalg.norm(query_emb) * np.linalg.norm(emb)))
-                scored.append((sim, i))
-            else:
-                # Skip or log mismatched embedding sizes
-                continue
-        scored.sort(reverse=True, key=lambda x: x[0])
+    query_emb = np.array((await embed_texts([query]))[0])
+    async with ReadSessionLocal() as session:
+        scored = await _vector_candidates(session, query_emb, body.project_id, 10)
+        items = await _fetch_texts_by_id(session, [tid for tid, _ in scored])
         top = [
-            {"id": i.id, "name": i.name, "filename": i.filename, "image_url": (f"/uploads/{i.filename}" if i.filename else None), "text": i.text, "created_at": i.created_at.isoformat(), "score": sim, "project_id": i.project_id}
-            for sim, i in scored[:10]
+            {**_text_row(i, "/uploads/"), "score": sim}
+            for i, sim in ((items.get(tid), sim) for tid, sim in scored) if i
         ]
         return top 
 
-@app.get("/stats")
-async def get_stats(project_id: int | None = None):
-    async with SessionLocal() as session:
+
+async def _vector_candidates(session, query_emb, project_id: int | None, limit: int) -> list[tuple[int, float]]:
+    """Top (text_id, cosine) pairs for EMBEDDING_MODEL, from the shared index when it is built."""
+    index = _get_vector_index()
+    if index is not None:
+        scored = await asyncio.to_thread(_search_index, index, query_emb, project_id, limit)
+        if scored is not None:
+            return scored
+    # Fallback while the index is building (or disabled): scored in Postgres
+    if project_id is None:
+        candidates = "SELECT te.text_id AS id, te.embedding FROM text_embeddings te WHERE te.model = :model"
+        params = {"model": EMBEDDING_MODEL}
+    else:
+        candidates = (
+            "SELECT te.text_id AS id, te.embedding FROM text_embeddings te "
+            "JOIN handwritten_texts ht ON ht.id = te.text_id WHERE te.model = :model AND ht.project_id = :pid"
+        )
+        params = {"model": EMBEDDING_MODEL, "pid": project_id}
+    return await _db_cosine_candidates(session, candidates, params, query_emb, limit)
+
+
+# Cosine similarity computed in SQL over (id, embedding) candidate rows. Still a scan of the
+# candidates, but only the top `limit` ids and scores are sent back to the application.
+_DB_COSINE_SQL = """
+    SELECT c.id, s.dot / NULLIF(s.norm * :qnorm, 0) AS score
+    FROM ({candidates}) c
+    CROSS JOIN LATERAL (
+      SELECT sum(e * q) AS dot, sqrt(sum(e * e)) AS norm
+      FROM unnest(c.embedding, CAST(:q AS double precision[])) AS u(e, q)
+    ) s
+    ORDER BY score DESC NULLS LAST
+    LIMIT :limit
+"""
+
+
+async def _db_cosine_candidates(session, candidates_sql: str, params: dict, query_emb, limit: int) -> list[tuple[int, float]]:
+    q = [float(x) for x in query_emb]
+    qnorm = math.sqrt(sum(x * x for x in q))
+    if not qnorm:
+        return []
+    result = await session.execute(
+        sa_text(_DB_COSINE_SQL.format(candidates=candidates_sql)),
+        {**params, "q": q, "qnorm": qnorm, "limit": limit},
+    )
+    return [(int(r[0]), float(r[1])) for r in result.all() if r[1] is not None]
+
+
+async def _lexical_candidates(session, query: str, project_id: int | None, limit: int) -> list[tuple[int, float]]:
+    """Top (text_id, rank) pairs from the full-text index ('simple' config keeps identifiers intact)."""
+    if project_id is None:
+        stmt = sa_text(
+            """
+            SELECT id, ts_rank_cd(to_tsvector('simple', text), websearch_to_tsquery('simple', :q)) AS rank
+            FROM handwritten_texts
+            WHERE to_tsvector('simple', text) @@ websearch_to_tsquery('simple', :q)
+            ORDER BY rank DESC, id DESC
+            LIMIT :limit
+            """
+        )
+        result = await session.execute(stmt, {"q": query, "limit": limit})
+    else:
+        stmt = sa_text(
+            """
+            SELECT id, ts_rank_cd(to_tsvector('simple', text), websearch_to_tsquery('simple', :q)) AS rank
+            FROM handwritten_texts
+            WHERE project_id = :pid AND to_tsvector('simple', text) @@ websearch_to_tsquery('simple', :q)
+            ORDER BY rank DESC, id DESC
+            LIMIT :limit
+            """
+        )
+        result = await session.execute(stmt, {"q": query, "limit": limit, "pid": project_id})
+    return [(int(r[0]), float(r[1])) for r in result.fetchall()]
+
+
+async def _fetch_texts_by_id(session, ids: list[int]) -> dict:
+    if not ids:
+        return {}
+    result = await session.execute(select(*_TEXT_COLUMNS).where(HandwrittenText.id.in_(ids)))
+    return {i.id: i for i in result.all()}
+
+
+class HybridQuery(BaseModel):
+    query: str
+    project_id: int | None = None
+    k: int = 10
+    candidates: int = 50  # per retriever, before fusion
+    rrf_k: int = 60       # reciprocal rank fusion damping constant (>= 1)
+
+@app.post("/texts/hybrid")
+async def hybrid_search(body: HybridQuery):
+    import numpy as np
+    query = body.query.strip()
+    if not query:
+        raise HTTPException(status_code=400, detail="Query must not be empty")
+    k = max(1, min(body.k, 100))
+    n_candidates = max(k, min(body.candidates, 500))
+    rrf_k = max(1, body.rrf_k)
+    # Lexical results still work if the embedding provider is unavailable
+    try:
+        query_emb = np.array((await embed_texts([query]))[0])
+    except Exception as e:
+        print("Embedding failed in /texts/hybrid, using lexical only:", e)
+        query_emb = None
+    async with ReadSessionLocal() as session:
+        lexical = await _lexical_candidates(session, query, body.project_id, n_candidates)
+        vector = await _vector_candidates(session, query_emb, body.project_id, n_candidates) if query_emb is not None else []
+
+        fused: dict[int, dict] = {}
+        for source, ranked in (("lexical", lexical), ("vector", vector)):
+            for rank, (tid, score) in enumerate(ranked, start=1):
+                entry = fused.setdefault(tid, {"score": 0.0, "lexical_score": None, "vector_score": None, "lexical_rank": None, "vector_rank": None})
+                entry["score"] += 1.0 / (rrf_k + rank)
+                entry[f"{source}_score"] = score
+                entry[f"{source}_rank"] = rank
+        ranked_ids = sorted(fused, key=lambda tid: fused[tid]["score"], reverse=True)[:k]
+        items = await _fetch_texts_by_id(session, ranked_ids)
+        return [
+            {**_text_row(i, "/uploads/"), **fused[i.id]}
+            for i in (items.get(tid) for tid in ranked_ids) if i
+        ]
+
+
+@app.post("/embeddings/backfill")
+async def embeddings_backfill(model: str | None = None):
+    try:
+        return await run_embedding_backfill(model or EMBEDDING_MODEL)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+
+@app.get("/embeddings/status")
+async def embeddings_status(project_id: int | None = None):
+    async with ReadSessionLocal() as session:
         if project_id is None:
-            count = await session.scalar(select(sa_func.count(HandwrittenText.id)))
-            min_date = await session.scalar(select(sa_func.min(HandwrittenText.created_at)))
-            max_date = await session.scalar(select(sa_func.max(HandwrittenText.created_at)))
-            avg_len = await session.scalar(select(sa_func.avg(sa_func.length(HandwrittenText.text))))
-        else:
-            count = await session.scalar(
-                select(sa_func.count(HandwrittenText.id)).where(HandwrittenText.project_id == project_id)
-            )
-            min_date = await session.scalar(
-                select(sa_func.min(HandwrittenText.created_at)).where(HandwrittenText.project_id == project_id)
-            )
-            max_date = await session.scalar(
-                select(sa_func.max(HandwrittenText.created_at)).where(HandwrittenText.project_id == project_id)
+            query = sa_text(
+                """
+                SELECT COUNT(*) FILTER (WHERE length(trim(ht.text)) > 0) AS embeddable,
+                       COUNT(te.id) AS embedded
+                FROM handwritten_texts ht
+                LEFT JOIN text_embeddings te ON te.text_id = ht.id AND te.model = :model
+                """
             )
-            avg_len = await session.scalar(
-                select(sa_func.avg(sa_func.length(HandwrittenText.text))).where(HandwrittenText.project_id == project_id)
+            result = await session.execute(query, {"model": EMBEDDING_MODEL})
+        else:
+            query = sa_text(
+                """
+                SELECT COUNT(*) FILTER (WHERE length(trim(ht.text)) > 0) AS embeddable,
+                       COUNT(te.id) AS embedded
+                FROM handwritten_texts ht
+                LEFT JOIN text_embeddings te ON te.text_id = ht.id AND te.model = :model
+                WHERE ht.project_id = :pid
+                """
             )
+            result = await session.execute(query, {"model": EMBEDDING_MODEL, "pid": project_id})
+        row = result.one()
+        embeddable, embedded = int(row[0]), int(row[1])
+    index = _get_vector_index()
+    index_stats = await asyncio.to_thread(index.stats) if index is not None else None
+    passage_index = _get_passage_index()
+    passage_index_stats = await asyncio.to_thread(passage_index.stats) if passage_index is not None else None
+    return {"model": EMBEDDING_MODEL, "embeddable": embeddable, "embedded": embedded, "missing": max(embeddable - embedded, 0), "index": index_stats, "passage_index": passage_index_stats}
+
+
+@app.post("/embeddings/index/rebuild")
+async def embeddings_index_rebuild():
+    try:
+        return {**await rebuild_vector_index(), "passages": await rebuild_passage_index()}
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+@app.get("/stats")
+async def get_stats(project_id: int | None = None):
+    async with ReadSessionLocal() as session:
+        # One pass over the precomputed counts instead of LENGTH(text) per row
+        stmt = select(
+            sa_func.count(HandwrittenText.id),
+            sa_func.min(HandwrittenText.created_at),
+            sa_func.max(HandwrittenText.created_at),
+            # LENGTH(text) is only evaluated for rows the backfill has not reached yet
+            sa_func.avg(sa_func.coalesce(HandwrittenText.char_count, sa_func.length(HandwrittenText.text))),
+            sa_func.avg(HandwrittenText.word_count),
+        )
+        lang_stmt = (
+            select(HandwrittenText.language, sa_func.count(HandwrittenText.id))
+            .group_by(HandwrittenText.language)
+            .order_by(sa_func.count(HandwrittenText.id).desc())
+        )
+        if project_id is not None:
+            stmt = stmt.where(HandwrittenText.project_id == project_id)
+            lang_stmt = lang_stmt.where(HandwrittenText.project_id == project_id)
+        count, min_date, max_date, avg_len, avg_words = (await session.execute(stmt)).one()
+        languages = (await session.execute(lang_stmt)).all()
         return {
             "count": count,
             "earliest": min_date.isoformat() if min_date else None,
             "latest": max_date.isoformat() if max_date else None,
-            "avg_text_length": avg_len
+            "avg_text_length": avg_len,
+            "avg_word_count": avg_words,
+            "languages": {(lang or "unknown"): int(c) for lang, c in languages},
         }
 
 from pydantic import BaseModel
@@ -545,10 +1642,81 @@ class SummarizeRequest(BaseModel):
     summarize_all: bool | None = None  # if true, summarize all texts (optionally in project)
 
 
+# Summary cache: rows keyed by sha256 of (input text, provider/model, length, format, instructions).
+# Project/all-texts entries are dropped when texts are added to or removed from that scope.
+SUMMARY_CACHE_TTL = float(os.getenv("SUMMARY_CACHE_TTL", str(7 * 24 * 3600)))  # seconds
+SUMMARY_CACHE_MAX_ENTRIES = int(os.getenv("SUMMARY_CACHE_MAX_ENTRIES", "5000"))
+
+
+def _summary_cache_key(text: str, provider_used: str, length: str, out_format: str, extra: str) -> str:
+    content_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return hashlib.sha256(json.dumps([content_hash, provider_used, length, out_format, extra]).encode("utf-8")).hexdigest()
+
+
+async def _summary_cache_get(key: str) -> str | None:
+    async with SessionLocal() as session:
+        # The lookup also bumps the shared hit/miss counter, so every worker reports the same rate
+        result = await session.execute(sa_text(
+            """
+            WITH hit AS (
+              UPDATE summary_cache SET hits = hits + 1, last_used_at = now()
+              WHERE key = :key AND last_used_at > now() - make_interval(secs => :ttl)
+              RETURNING summary
+            ), counted AS (
+              INSERT INTO summary_cache_counters (name, value)
+              SELECT CASE WHEN EXISTS (SELECT 1 FROM hit) THEN 'hits' ELSE 'misses' END, 1
+              ON CONFLICT (name) DO UPDATE SET value = summary_cache_counters.value + 1
+            )
+            SELECT summary FROM hit
+            """
+        ), {"key": key, "ttl": SUMMARY_CACHE_TTL})
+        row = result.first()
+        await session.commit()
+    return row[0] if row is not None else None
+
+
+async def _summary_cache_put(key: str, scope: str, project_id: int | None, text_id: int | None, provider_used: str, summary: str):
+    async with SessionLocal() as session:
+        await session.execute(pg_insert(SummaryCache).values(
+            key=key, scope=scope, project_id=project_id, text_id=text_id, provider=provider_used, summary=summary
+        ).on_conflict_do_update(
+            index_elements=["key"], set_={"summary": summary, "last_used_at": sa_func.now()}
+        ))
+        # Evict expired entries, then the least recently used beyond the size cap
+        await session.execute(sa_text(
+            "DELETE FROM summary_cache WHERE last_used_at <= now() - make_interval(secs => :ttl)"
+        ), {"ttl": SUMMARY_CACHE_TTL})
+        await session.execute(sa_text(
+            """
+            DELETE FROM summary_cache WHERE key IN (
+              SELECT key FROM summary_cache ORDER BY last_used_at DESC OFFSET :max_entries
+            )
+            """
+        ), {"max_entries": SUMMARY_CACHE_MAX_ENTRIES})
+        await session.commit()
+
+
+async def _invalidate_summaries(session, project_ids=(), text_ids=()):
+    """Drop cached summaries whose input changed; call inside the session that adds/deletes texts."""
+    project_ids = [p for p in set(project_ids) if p is not None]
+    await session.execute(sa_text("DELETE FROM summary_cache WHERE scope = 'all'"))
+    if project_ids:
+        await session.execute(
+            delete(SummaryCache).where(SummaryCache.scope == "project", SummaryCache.project_id.in_(project_ids))
+        )
+    if text_ids:
+        await session.execute(
+            delete(SummaryCache).where(SummaryCache.scope == "text", SummaryCache.text_id.in_(list(text_ids)))
+        )
+
+
 @app.post("/texts/summarize")
 async def summarize_text(body: SummarizeRequest):
     use_provider = body.provider or DEFAULT_PROVIDER
     text_to_summarize = body.text
+    cache_scope = "adhoc"
+    cache_text_id = None
+    cache_project_id = None
 
     # Defaults
     length = (body.summary_length or "medium").lower()
@@ -572,6 +1740,8 @@ async def summarize_text(body: SummarizeRequest):
                     raise HTTPException(status_code=404, detail="No texts found to summarize")
                 # Naive concatenation; consider chunking for very large corpora
                 text_to_summarize = "\n\n".join(texts)
+            cache_scope = "project" if body.project_id is not None else "all"
+            cache_project_id = body.project_id
         elif body.text_id is None:
             raise HTTPException(status_code=400, detail="Provide text_id, text, or set summarize_all=true")
         else:
@@ -581,6 +1751,15 @@ async def summarize_text(body: SummarizeRequest):
                 if not item:
                     raise HTTPException(status_code=404, detail="Text not found")
                 text_to_summarize = item.text
+            cache_scope = "text"
+            cache_text_id = item.id
+            cache_project_id = item.project_id
+
+    provider_used = provider_label(use_provider, body.model)
+    cache_key = _summary_cache_key(text_to_summarize, provider_used, length, out_format, extra)
+    cached = await _summary_cache_get(cache_key)
+    if cached is not None:
+        return {"summary": cached, "provider": provider_used, "length": length, "format": out_format, "cached": True}
 
     # Construct prompt according to parameters
     length_clause = {
@@ -595,38 +1774,115 @@ async def summarize_text(body: SummarizeRequest):
         f"{length_clause} {format_clause}{extra_clause}\n\nTEXT:\n"
     )
 
+    async def generate_summary() -> str:
+        # Adapt max tokens according to requested length (OpenAI only)
+        max_tokens = {"short": 250, "medium": 400, "long": 800}[length]
+        return await generate_text(use_provider, body.model, prompt_header + text_to_summarize, max_tokens)
+
     try:
-        if use_provider == "ollama":
-            ollama_model = body.model or OLLAMA_MODEL
-            prompt = prompt_header + text_to_summarize
-            summary = ollama_generate(prompt, model=ollama_model)
-            provider_used = f"ollama:{ollama_model}"
-        elif use_provider == "gemini":
-            gemini_model = body.model or GEMINI_MODEL
-            prompt = prompt_header + text_to_summarize
-            summary = await perform_gemini_text(prompt, model=gemini_model)
-            provider_used = f"gemini:{gemini_model}"
-        else:
-            # Adapt max tokens according to requested length
-            max_tokens = {"short": 250, "medium": 400, "long": 800}[length]
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt_header + text_to_summarize,
-                    }
-                ],
-                max_tokens=max_tokens,
-            )
-            summary = response.choices[0].message.content
-            provider_used = "openai:gpt-4o"
-        return {"summary": summary, "provider": provider_used, "length": length, "format": out_format}
+        # Concurrent identical requests (same cache key) share one upstream call
+        summary = await _singleflight.do(cache_key, generate_summary)
+        if summary:
+            await _summary_cache_put(cache_key, cache_scope, cache_project_id, cache_text_id, provider_used, summary)
+        return {"summary": summary, "provider": provider_used, "length": length, "format": out_format, "cached": False}
+    except ProviderOverloaded:
+        raise
     except Exception as e:
         print("Exception in /texts/summarize:", e)
         traceback.print_exc()
         return JSONResponse(status_code=500, content={"error": str(e)}) 
 
+
+class AskRequest(BaseModel):
+    question: str
+    provider: str | None = None
+    model: str | None = None
+    top_k: int = 6
+
+
+async def _passage_candidates(session, query_emb, project_id: int, limit: int) -> list[tuple[int, float]]:
+    """Top (chunk_id, cosine) pairs of a project, from the passage index when it is built."""
+    index = _get_passage_index()
+    if index is not None:
+        scored = await asyncio.to_thread(_search_index, index, query_emb, project_id, limit)
+        if scored is not None:
+            return scored
+    return await _db_cosine_candidates(
+        session,
+        "SELECT tc.id, tc.embedding FROM text_chunks tc WHERE tc.project_id = :pid AND tc.model = :model",
+        {"pid": project_id, "model": EMBEDDING_MODEL},
+        query_emb,
+        limit,
+    )
+
+
+@app.post("/projects/{project_id}/ask")
+async def ask_project(project_id: int, body: AskRequest):
+    import numpy as np
+    question = body.question.strip()
+    if not question:
+        raise HTTPException(status_code=400, detail="Question must not be empty")
+    top_k = max(1, min(body.top_k, 20))
+    use_provider = body.provider or DEFAULT_PROVIDER
+    try:
+        # Embed before checking out a connection: the provider call can wait in its queue and retry
+        query_emb = np.array((await embed_texts([question]))[0], dtype=np.float32)
+        async with ReadSessionLocal() as session:
+            project = await session.scalar(select(Project).where(Project.id == project_id))
+            if not project:
+                raise HTTPException(status_code=404, detail="Project not found")
+            # Top passages from the shared passage index; passage text is fetched for the winners only
+            scored = await _passage_candidates(session, query_emb, project_id, top_k)
+            if not scored:
+                raise HTTPException(status_code=404, detail="No indexed passages for this project yet")
+            chunk_ids = [cid for cid, _ in scored]
+            scores = dict(scored)
+            result = await session.execute(select(TextChunk).where(TextChunk.id.in_(chunk_ids)))
+            chunks = {c.id: c for c in result.scalars().all()}
+        passages = [chunks[cid] for cid in chunk_ids if cid in chunks]
+
+        context = "\n\n".join(f"[{n}] {c.content}" for n, c in enumerate(passages, start=1))
+        prompt = (
+            "Answer the question using only the numbered passages below, which were transcribed from "
+            "handwritten or scanned documents. Cite passage numbers like [1]. If the passages do not "
+            "contain the answer, say so.\n\n"
+            f"PASSAGES:\n{context}\n\nQUESTION: {question}\n"
+        )
+        answer = await generate_text(use_provider, body.model, prompt)
+        return {
+            "answer": answer,
+            "provider": provider_label(use_provider, body.model),
+            "passages": [
+                {"rank": n, "text_id": c.text_id, "chunk_index": c.chunk_index, "score": scores[c.id], "content": c.content}
+                for n, c in enumerate(passages, start=1)
+            ],
+        }
+    except (HTTPException, ProviderOverloaded):
+        raise
+    except Exception as e:
+        print("Exception in /projects/{id}/ask:", e)
+        traceback.print_exc()
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+
+@app.get("/texts/summarize/cache")
+async def summary_cache_stats():
+    async with ReadSessionLocal() as session:
+        entries = await session.scalar(select(sa_func.count()).select_from(SummaryCache))
+        total_hits = await session.scalar(select(sa_func.coalesce(sa_func.sum(SummaryCache.hits), 0)))
+        counters = dict((await session.execute(select(SummaryCacheCounter.name, SummaryCacheCounter.value))).all())
+    # hits/misses count every lookup on every worker; stored_hits_total only covers entries still cached
+    hits, misses = int(counters.get("hits", 0)), int(counters.get("misses", 0))
+    return {
+        "entries": entries,
+        "max_entries": SUMMARY_CACHE_MAX_ENTRIES,
+        "ttl_seconds": SUMMARY_CACHE_TTL,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": (hits / (hits + misses)) if hits + misses else None,
+        "stored_hits_total": int(total_hits or 0),
+    }
+
 @app.get("/db/schemas")
 async def list_db_schemas():
     try:
@@ -673,7 +1929,7 @@ async def list_db_tables(schema: str | None = None):
 @app.get("/analytics/project_counts")
 async def analytics_project_counts():
     try:
-        async with SessionLocal() as session:
+        async with ReadSessionLocal() as session:
             query = sa_text(
                 """
                 SELECT p.id, p.name, COALESCE(COUNT(ht.id), 0) AS num_texts
@@ -694,7 +1950,7 @@ async def analytics_activity(project_id: int | None = None, interval: str = "day
     try:
         interval = interval if interval in {"hour", "day", "week", "month"} else "day"
         points = max(1, min(points, 365))
-        async with SessionLocal() as session:
+        async with ReadSessionLocal() as session:
             if project_id is None:
                 query = sa_text(
                     f"""
@@ -728,18 +1984,20 @@ async def analytics_activity(project_id: int | None = None, interval: str = "day
 async def analytics_length_histogram(project_id: int | None = None, bins: int = 10):
     try:
         bins = max(2, min(bins, 50))
-        async with SessionLocal() as session:
+        async with ReadSessionLocal() as session:
             if project_id is None:
                 query = sa_text(
                     """
-                    WITH stats AS (
-                      SELECT MIN(LENGTH(text)) AS minlen, MAX(LENGTH(text)) AS maxlen FROM handwritten_texts
+                    WITH filtered AS (
+                      SELECT COALESCE(char_count, LENGTH(text)) AS len FROM handwritten_texts
+                    ), stats AS (
+                      SELECT MIN(len) AS minlen, MAX(len) AS maxlen FROM filtered
                     )
-                    SELECT width_bucket(LENGTH(ht.text), stats.minlen, stats.maxlen + 1, :bins) AS bucket,
+                    SELECT width_bucket(f.len, stats.minlen, stats.maxlen + 1, :bins) AS bucket,
                            COUNT(*) AS c,
                            stats.minlen AS minlen,
                            stats.maxlen AS maxlen
-                    FROM handwritten_texts ht, stats
+                    FROM filtered f, stats
                     GROUP BY bucket, stats.minlen, stats.maxlen
                     ORDER BY bucket
                     """
@@ -749,11 +2007,11 @@ async def analytics_length_histogram(project_id: int | None = None, bins: int =
                 query = sa_text(
                     """
                     WITH filtered AS (
-                      SELECT text FROM handwritten_texts WHERE project_id = :pid
+                      SELECT COALESCE(char_count, LENGTH(text)) AS len FROM handwritten_texts WHERE project_id = :pid
                     ), stats AS (
-                      SELECT MIN(LENGTH(text)) AS minlen, MAX(LENGTH(text)) AS maxlen FROM filtered
+                      SELECT MIN(len) AS minlen, MAX(len) AS maxlen FROM filtered
                     )
-                    SELECT width_bucket(LENGTH(f.text), stats.minlen, stats.maxlen + 1, :bins) AS bucket,
+                    SELECT width_bucket(f.len, stats.minlen, stats.maxlen + 1, :bins) AS bucket,
                            COUNT(*) AS c,
                            stats.minlen AS minlen,
                            stats.maxlen AS maxlen
@@ -773,11 +2031,31 @@ async def analytics_length_histogram(project_id: int | None = None, bins: int =
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+@app.get("/analytics/ocr_tiers")
+async def analytics_ocr_tiers(project_id: int | None = None):
+    """How often each OCR tier/provider answered, with mean Tesseract confidence, for tuning routing thresholds."""
+    try:
+        async with ReadSessionLocal() as session:
+            stmt = (
+                select(HandwrittenText.ocr_tier, HandwrittenText.ocr_provider, sa_func.count(HandwrittenText.id), sa_func.avg(HandwrittenText.ocr_confidence))
+                .group_by(HandwrittenText.ocr_tier, HandwrittenText.ocr_provider)
+                .order_by(sa_func.count(HandwrittenText.id).desc())
+            )
+            if project_id is not None:
+                stmt = stmt.where(HandwrittenText.project_id == project_id)
+            rows = (await session.execute(stmt)).all()
+            return {"tiers": [
+                {"tier": r[0] or "(unknown)", "provider": r[1], "count": int(r[2]), "avg_confidence": float(r[3]) if r[3] is not None else None}
+                for r in rows
+            ]}
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
 @app.get("/analytics/top_filenames")
 async def analytics_top_filenames(project_id: int | None = None, limit: int = 10):
     try:
         limit = max(1, min(limit, 100))
-        async with SessionLocal() as session:
+        async with ReadSessionLocal() as session:
             if project_id is None:
                 query = sa_text(
                     """
@@ -0,0 +1,192 @@
+from sqlalchemy import text as sa_text
+from sqlalchemy.exc import DBAPIError
+
+# Versioned schema migrations. Startup reads the current version from schema_migrations
+# (a single row lookup) and only runs the steps above it. Append new steps; never edit
+# or renumber applied ones. Each step is a list of SQL strings or callables taking a sync connection.
+# Tables are spelled out as DDL rather than created from models.py, so a step means the same thing
+# however the models change later.
+MIGRATIONS = [
+    (1, [
+        # Baseline schema (as earlier releases created it with create_all); the ALTERs cover
+        # databases created before these columns existed
+        """
+        CREATE TABLE IF NOT EXISTS projects (
+          id SERIAL PRIMARY KEY,
+          name varchar(128) NOT NULL,
+          description text,
+          created_at timestamptz DEFAULT now()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_projects_id ON projects(id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_projects_name ON projects(name)",
+        """
+        CREATE TABLE IF NOT EXISTS handwritten_texts (
+          id SERIAL PRIMARY KEY,
+          name varchar(256),
+          filename varchar(256),
+          text text NOT NULL,
+          created_at timestamptz DEFAULT now(),
+          embedding double precision[],
+          project_id integer REFERENCES projects(id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_handwritten_texts_id ON handwritten_texts(id)",
+        """
+        CREATE TABLE IF NOT EXISTS text_embeddings (
+          id SERIAL PRIMARY KEY,
+          text_id integer NOT NULL REFERENCES handwritten_texts(id) ON DELETE CASCADE,
+          model varchar(128) NOT NULL,
+          dim integer NOT NULL,
+          embedding double precision[] NOT NULL,
+          created_at timestamptz DEFAULT now(),
+          CONSTRAINT uq_text_embeddings_text_model UNIQUE (text_id, model)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_text_embeddings_id ON text_embeddings(id)",
+        "CREATE INDEX IF NOT EXISTS ix_text_embeddings_text_id ON text_embeddings(text_id)",
+        "CREATE INDEX IF NOT EXISTS ix_text_embeddings_model ON text_embeddings(model)",
+        "ALTER TABLE handwritten_texts ADD COLUMN IF NOT EXISTS project_id integer REFERENCES projects(id)",
+        "CREATE INDEX IF NOT EXISTS idx_handwritten_texts_project_id ON handwritten_texts(project_id)",
+        "ALTER TABLE handwritten_texts ADD COLUMN IF NOT EXISTS name varchar(256)",
+        "CREATE INDEX IF NOT EXISTS idx_handwritten_texts_name ON handwritten_texts(name)",
+    ]),
+    (2, [
+        # Perceptual hash of the uploaded image for near-duplicate detection
+        "ALTER TABLE handwritten_texts ADD COLUMN IF NOT EXISTS phash bigint",
+    ]),
+    (3, [
+        # Full-text index backing the lexical half of /texts/hybrid
+        "CREATE INDEX IF NOT EXISTS idx_handwritten_texts_fts ON handwritten_texts USING GIN (to_tsvector('simple', text))",
+    ]),
+    (4, [
+        """
+        CREATE TABLE IF NOT EXISTS summary_cache (
+          key varchar(64) PRIMARY KEY,
+          scope varchar(16) NOT NULL,
+          project_id integer,
+          text_id integer,
+          provider varchar(256) NOT NULL,
+          summary text NOT NULL,
+          hits integer NOT NULL DEFAULT 0,
+          created_at timestamptz DEFAULT now(),
+          last_used_at timestamptz DEFAULT now()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_summary_cache_project_id ON summary_cache(project_id)",
+        "CREATE INDEX IF NOT EXISTS ix_summary_cache_text_id ON summary_cache(text_id)",
+        "CREATE INDEX IF NOT EXISTS ix_summary_cache_last_used_at ON summary_cache(last_used_at)",
+    ]),
+    (5, [
+        """
+        CREATE TABLE IF NOT EXISTS text_chunks (
+          id SERIAL PRIMARY KEY,
+          text_id integer NOT NULL REFERENCES handwritten_texts(id) ON DELETE CASCADE,
+          project_id integer,
+          model varchar(128) NOT NULL,
+          chunk_index integer NOT NULL,
+          content text NOT NULL,
+          embedding double precision[] NOT NULL,
+          created_at timestamptz DEFAULT now(),
+          CONSTRAINT uq_text_chunks_text_model_index UNIQUE (text_id, model, chunk_index)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_text_chunks_id ON text_chunks(id)",
+        "CREATE INDEX IF NOT EXISTS ix_text_chunks_text_id ON text_chunks(text_id)",
+        "CREATE INDEX IF NOT EXISTS ix_text_chunks_project_id ON text_chunks(project_id)",
+        "CREATE INDEX IF NOT EXISTS idx_text_chunks_project_model ON text_chunks(project_id, model)",
+    ]),
+    (6, [
+        # Which OCR tier answered, for /analytics/ocr_tiers
+        "ALTER TABLE handwritten_texts ADD COLUMN IF NOT EXISTS ocr_tier varchar(16)",
+        "ALTER TABLE handwritten_texts ADD COLUMN IF NOT EXISTS ocr_provider varchar(256)",
+        "ALTER TABLE handwritten_texts ADD COLUMN IF NOT EXISTS ocr_confidence double precision",
+        "CREATE INDEX IF NOT EXISTS ix_handwritten_texts_ocr_tier ON handwritten_texts(ocr_tier)",
+    ]),
+    (7, [
+        # Derived text columns read by /stats, /analytics/length_histogram and /texts/search
+        "ALTER TABLE handwritten_texts ADD COLUMN IF NOT EXISTS char_count integer",
+        "ALTER TABLE handwritten_texts ADD COLUMN IF NOT EXISTS word_count integer",
+        "ALTER TABLE handwritten_texts ADD COLUMN IF NOT EXISTS normalized_text text",
+        "ALTER TABLE handwritten_texts ADD COLUMN IF NOT EXISTS language varchar(16)",
+        "ALTER TABLE handwritten_texts ADD COLUMN IF NOT EXISTS content_hash varchar(64)",
+        "CREATE INDEX IF NOT EXISTS ix_handwritten_texts_char_count ON handwritten_texts(char_count)",
+        "CREATE INDEX IF NOT EXISTS idx_handwritten_texts_project_char_count ON handwritten_texts(project_id, char_count)",
+        "CREATE INDEX IF NOT EXISTS ix_handwritten_texts_language ON handwritten_texts(language)",
+        "CREATE INDEX IF NOT EXISTS ix_handwritten_texts_content_hash ON handwritten_texts(content_hash)",
+        lambda sync_conn: _create_trigram_index(sync_conn),
+        # Existing rows are filled in batches after startup (main.run_text_features_backfill)
+    ]),
+    (8, [
+        # One-time copy of vectors stored on handwritten_texts.embedding before text_embeddings existed
+        # (the column is no longer written). Only 1536-dim vectors can be attributed with confidence
+        # (OpenAI text-embedding-3-small); Ollama vectors came from whichever model the request named,
+        # so they are left out and the embedding backfill recomputes them.
+        """
+        INSERT INTO text_embeddings (text_id, model, dim, embedding)
+        SELECT ht.id, 'openai:text-embedding-3-small', 1536, ht.embedding
+        FROM handwritten_texts ht
+        WHERE ht.embedding IS NOT NULL AND array_length(ht.embedding, 1) = 1536
+        ON CONFLICT (text_id, model) DO NOTHING
+        """,
+    ]),
+    (9, [
+        # Shared hit/miss counters for /texts/summarize/cache
+        "CREATE TABLE IF NOT EXISTS summary_cache_counters (name varchar(16) PRIMARY KEY, value bigint NOT NULL DEFAULT 0)",
+    ]),
+]
+LEGACY_EMBEDDINGS_VERSION = 8
+
+
+def _create_trigram_index(sync_conn):
+    """Trigram index so substring search on normalized_text does not scan the table.
+    CREATE EXTENSION needs privileges the app role may lack; then search runs without the index."""
+    try:
+        with sync_conn.begin_nested():
+            sync_conn.execute(sa_text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            sync_conn.execute(sa_text(
+                "CREATE INDEX IF NOT EXISTS idx_handwritten_texts_normalized_trgm "
+                "ON handwritten_texts USING GIN (normalized_text gin_trgm_ops)"
+            ))
+    except DBAPIError as e:
+        print("pg_trgm unavailable, /texts/search will scan normalized_text:", e)
+
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+_MIGRATION_LOCK_ID = 7200
+
+
+async def current_schema_version(engine) -> int:
+    async with engine.connect() as conn:
+        try:
+            version = await conn.scalar(sa_text("SELECT MAX(version) FROM schema_migrations"))
+        except DBAPIError:
+            # Table does not exist yet: fresh database or one that predates versioning
+            return 0
+        return int(version or 0)
+
+
+async def run_migrations(engine) -> list[int]:
+    """Apply pending migrations and return the versions applied (empty on the fast path)."""
+    if await current_schema_version(engine) >= LATEST_VERSION:
+        return []
+    applied = []
+    async with engine.begin() as conn:
+        # Serialise concurrent replicas; the lock is released at commit
+        await conn.execute(sa_text("SELECT pg_advisory_xact_lock(:k)"), {"k": _MIGRATION_LOCK_ID})
+        await conn.execute(sa_text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version integer PRIMARY KEY, applied_at timestamptz NOT NULL DEFAULT now())"
+        ))
+        current = int(await conn.scalar(sa_text("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")))
+        for version, steps in MIGRATIONS:
+            if version <= current:
+                continue
+            for step in steps:
+                if callable(step):
+                    await conn.run_sync(step)
+                else:
+                    await conn.execute(sa_text(step))
+            await conn.execute(sa_text("INSERT INTO schema_migrations (version) VALUES (:v)"), {"v": version})
+            applied.append(version)
+    return applied
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ARRAY, Float, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, Text, DateTime, ARRAY, Float, ForeignKey, UniqueConstraint
 from sqlalchemy.sql import func
 from db import Base
 
@@ -16,5 +16,62 @@ class HandwrittenText(Base):
     filename = Column(String(256), nullable=True)
     text = Column(Text, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    embedding = Column(ARRAY(Float), nullable=True)
-    project_id = Column(Integer, ForeignKey("projects.id"), nullable=True, index=True) 
\ No newline at end of file
+    embedding = Column(ARRAY(Float), nullable=True)  # legacy, no longer written; copied to text_embeddings by migration 8
+    project_id = Column(Integer, ForeignKey("projects.id"), nullable=True, index=True) 
+    phash = Column(BigInteger, nullable=True)  # perceptual hash of the uploaded image (signed 64-bit)
+    ocr_tier = Column(String(16), nullable=True, index=True)  # 'tesseract' | 'llm' | 'duplicate'
+    ocr_provider = Column(String(256), nullable=True)  # stage that produced the text, e.g. 'openai+preprocess'
+    ocr_confidence = Column(Float, nullable=True)  # mean Tesseract word confidence when it was consulted
+    # Derived from text once at ingest (utils.text_features)
+    char_count = Column(Integer, nullable=True, index=True)
+    word_count = Column(Integer, nullable=True)
+    normalized_text = Column(Text, nullable=True)  # NFKC + casefold + collapsed whitespace, for search
+    language = Column(String(16), nullable=True, index=True)
+    content_hash = Column(String(64), nullable=True, index=True)  # sha256 of normalized_text
+
+
+# One row per (text, embedding model) so each model forms a complete search space
+class TextEmbedding(Base):
+    __tablename__ = "text_embeddings"
+    __table_args__ = (UniqueConstraint("text_id", "model", name="uq_text_embeddings_text_model"),)
+    id = Column(Integer, primary_key=True, index=True)
+    text_id = Column(Integer, ForeignKey("handwritten_texts.id", ondelete="CASCADE"), nullable=False, index=True)
+    model = Column(String(128), nullable=False, index=True)  # e.g. "openai:text-embedding-3-small"
+    dim = Column(Integer, nullable=False)
+    embedding = Column(ARRAY(Float), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+# Persistent summary cache keyed by a hash of the input text and every generation parameter
+class SummaryCache(Base):
+    __tablename__ = "summary_cache"
+    key = Column(String(64), primary_key=True)
+    scope = Column(String(16), nullable=False)  # 'text' | 'project' | 'all' | 'adhoc'
+    project_id = Column(Integer, nullable=True, index=True)
+    text_id = Column(Integer, nullable=True, index=True)
+    provider = Column(String(256), nullable=False)
+    summary = Column(Text, nullable=False)
+    hits = Column(Integer, nullable=False, server_default="0")
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    last_used_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+
+# Cluster-wide lookup counters for the summary cache ('hits', 'misses'), shared by every worker
+class SummaryCacheCounter(Base):
+    __tablename__ = "summary_cache_counters"
+    name = Column(String(16), primary_key=True)
+    value = Column(BigInteger, nullable=False, server_default="0")
+
+
+# Passages of a text with their own embeddings, used for retrieval in /projects/{id}/ask
+class TextChunk(Base):
+    __tablename__ = "text_chunks"
+    __table_args__ = (UniqueConstraint("text_id", "model", "chunk_index", name="uq_text_chunks_text_model_index"),)
+    id = Column(Integer, primary_key=True, index=True)
+    text_id = Column(Integer, ForeignKey("handwritten_texts.id", ondelete="CASCADE"), nullable=False, index=True)
+    project_id = Column(Integer, nullable=True, index=True)
+    model = Column(String(128), nullable=False)
+    chunk_index = Column(Integer, nullable=False)
+    content = Column(Text, nullable=False)
+    embedding = Column(ARRAY(Float), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
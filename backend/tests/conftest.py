@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Backend modules are flat (imported as `vector_index`, `utils`...), as in the app container
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,155 @@
+import asyncio
+
+import pytest
+
+from concurrency import Deadline, DeadlineExceeded, ProviderLimiter, ProviderOverloaded, SingleFlight, UpstreamError, retry_with_backoff
+
+
+def test_retry_that_cannot_fit_in_deadline_raises_deadline_exceeded():
+    calls = 0
+
+    async def flaky():
+        nonlocal calls
+        calls += 1
+        raise UpstreamError("upstream 503", 503, retry_after=5)
+
+    with pytest.raises(DeadlineExceeded) as info:
+        asyncio.run(retry_with_backoff(flaky, 4, 0.1, 10, Deadline(1)))
+    assert calls == 1
+    assert isinstance(info.value.__cause__, UpstreamError)
+
+
+def test_last_attempt_keeps_upstream_error():
+    async def flaky():
+        raise UpstreamError("upstream 500", 500)
+
+    with pytest.raises(UpstreamError):
+        asyncio.run(retry_with_backoff(flaky, 1, 0.01, 1, Deadline(10)))
+
+
+def test_queue_wait_is_capped_by_deadline():
+    async def scenario():
+        limiter = ProviderLimiter("test", 0, 1, 1, 4, 10)
+        release = asyncio.Event()
+
+        async def hold():
+            await release.wait()
+
+        holder = asyncio.create_task(limiter.run(hold))
+        await asyncio.sleep(0)
+        try:
+            with pytest.raises(DeadlineExceeded):
+                await limiter.run(hold, timeout=0.05)
+        finally:
+            release.set()
+            await holder
+
+    asyncio.run(scenario())
+
+
+def test_singleflight_shares_one_call_between_concurrent_callers():
+    async def scenario():
+        flight = SingleFlight()
+        calls = 0
+        release = asyncio.Event()
+
+        async def work():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return "result"
+
+        waiters = [asyncio.create_task(flight.do("key", work)) for _ in range(3)]
+        other = asyncio.create_task(flight.do("other", work))
+        await asyncio.sleep(0)
+        release.set()
+        assert await asyncio.gather(*waiters, other) == ["result"] * 4
+        assert calls == 2
+        assert flight.stats()["coalesced"] == 2
+
+    asyncio.run(scenario())
+
+
+def test_singleflight_cancelled_waiter_does_not_cancel_shared_call():
+    async def scenario():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def work():
+            await release.wait()
+            return 42
+
+        first = asyncio.create_task(flight.do("key", work))
+        second = asyncio.create_task(flight.do("key", work))
+        await asyncio.sleep(0)
+        first.cancel()  # e.g. the first client disconnected
+        await asyncio.sleep(0)
+        release.set()
+        assert await second == 42
+        assert first.cancelled()
+
+    asyncio.run(scenario())
+
+
+def test_singleflight_releases_key_after_exception():
+    async def scenario():
+        flight = SingleFlight()
+        calls = 0
+
+        async def failing():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0)
+            raise ValueError("boom")
+
+        results = await asyncio.gather(flight.do("key", failing), flight.do("key", failing), return_exceptions=True)
+        assert all(isinstance(r, ValueError) for r in results)
+        assert calls == 1
+        await asyncio.sleep(0)  # done callbacks run on the next loop iteration
+        assert flight.stats()["in_flight"] == 0
+
+        async def ok():
+            return "retried"
+
+        assert await flight.do("key", ok) == "retried"
+
+    asyncio.run(scenario())
+
+
+def test_limiter_sheds_when_queue_is_full():
+    async def scenario():
+        limiter = ProviderLimiter("test", 0, 1, 1, 1, 10)
+        release = asyncio.Event()
+
+        async def hold():
+            await release.wait()
+
+        holder = asyncio.create_task(limiter.run(hold))
+        queued = asyncio.create_task(limiter.run(hold))
+        await asyncio.sleep(0)
+        assert limiter.stats()["waiting"] == 1
+        try:
+            with pytest.raises(ProviderOverloaded) as info:
+                await limiter.run(hold)
+            assert info.value.retry_after == 10
+            assert limiter.stats()["shed"] == 1
+        finally:
+            release.set()
+            await asyncio.gather(holder, queued)
+        assert limiter.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_rate_limit_on_last_attempt_becomes_provider_overloaded():
+    calls = 0
+
+    async def limited():
+        nonlocal calls
+        calls += 1
+        raise UpstreamError("upstream 429", 429, retry_after=0)
+
+    with pytest.raises(ProviderOverloaded) as info:
+        asyncio.run(retry_with_backoff(limited, 2, 0.01, 1))
+    assert calls == 2
+    assert isinstance(info.value.__cause__, UpstreamError)
@@ -0,0 +1,128 @@
+import numpy as np
+
+from vector_index import MmapVectorIndex, OP_ADD, OP_DELETE
+
+MODEL = "openai:text-embedding-3-small"
+
+
+def _vec(*values):
+    return np.array(values, dtype=np.float32)
+
+
+def _ids(results):
+    return [tid for tid, _ in results]
+
+
+def _build(index, dim, rows, during_build=None):
+    handle = index.try_lock()
+    assert handle is not None
+    try:
+        builder = index.begin_build(dim)
+        if during_build is not None:
+            during_build()
+        builder.add(rows)
+        builder.finish()
+    finally:
+        index.unlock(handle)
+
+
+def test_appends_during_build_land_in_new_generation(tmp_path):
+    builder_worker = MmapVectorIndex(tmp_path, MODEL)
+    other_worker = MmapVectorIndex(tmp_path, MODEL)
+
+    def concurrent_writes():
+        # Committed after the rebuild's snapshot: a new text and a deletion of a snapshotted one
+        assert other_worker.append(OP_ADD, [(10, 1, _vec(0, 0, 1))])
+        assert other_worker.append(OP_DELETE, [(2, None, None)])
+
+    _build(builder_worker, 3, [(1, 1, _vec(1, 0, 0)), (2, 1, _vec(0, 1, 0)), (3, 2, _vec(1, 1, 0))], concurrent_writes)
+
+    reader = MmapVectorIndex(tmp_path, MODEL)
+    assert reader.ready
+    results = reader.search(_vec(0, 1, 1), None, 10)
+    assert 10 in _ids(results)
+    assert 2 not in _ids(results)  # tombstoned by the log
+    assert _ids(reader.search(_vec(1, 0, 0), 2, 10)) == [3]  # project filter
+    assert reader.stats()["base_count"] == 3
+    assert reader.stats()["log_records"] == 2
+
+
+def test_other_workers_see_appends_and_readd_after_delete(tmp_path):
+    _build(MmapVectorIndex(tmp_path, MODEL), 2, [(1, None, _vec(1, 0)), (2, None, _vec(0, 1))])
+    a = MmapVectorIndex(tmp_path, MODEL)
+    b = MmapVectorIndex(tmp_path, MODEL)
+    assert a.ready and b.ready
+
+    a.append(OP_DELETE, [(1, None, None)])
+    assert _ids(b.search(_vec(1, 0), None, 5)) == [2]
+    a.append(OP_ADD, [(1, None, _vec(1, 0))])
+    top_id, score = b.search(_vec(1, 0), None, 5)[0]
+    assert top_id == 1 and abs(score - 1.0) < 1e-6
+
+
+def test_rebuild_replaces_generation_and_removes_old_files(tmp_path):
+    index = MmapVectorIndex(tmp_path, MODEL)
+    _build(index, 2, [(1, None, _vec(1, 0))])
+    index.append(OP_ADD, [(2, None, _vec(0, 1))])
+    first_gen = index.stats()["generation"]
+
+    _build(index, 2, [(1, None, _vec(1, 0)), (2, None, _vec(0, 1))])
+    stats = index.stats()
+    assert stats["generation"] > first_gen
+    assert stats["base_count"] == 2 and stats["log_records"] == 0
+    assert not any(p.name.startswith(f"{index.name}.{first_gen}.") for p in tmp_path.iterdir())
+    assert sorted(_ids(index.search(_vec(1, 1), None, 5))) == [1, 2]
+
+
+def test_rebuild_lock_is_exclusive_and_wrong_dimensions_are_skipped(tmp_path):
+    index = MmapVectorIndex(tmp_path, MODEL)
+    handle = index.try_lock()
+    assert handle is not None
+    assert MmapVectorIndex(tmp_path, MODEL).try_lock() is None
+    index.unlock(handle)
+
+    _build(index, 2, [(1, None, _vec(1, 0)), (2, None, _vec(1, 0, 0))])
+    index.append(OP_ADD, [(3, None, _vec(1, 2, 3))])
+    assert index.stats()["base_count"] == 1
+    assert _ids(index.search(_vec(1, 0), None, 5)) == [1]
+    assert index.search(_vec(1, 0, 0), None, 5) == []
+
+
+def test_other_models_files_are_left_alone(tmp_path):
+    other = MmapVectorIndex(tmp_path, "ollama:nomic-embed-text")
+    _build(other, 2, [(1, None, _vec(1, 0))])
+    index = MmapVectorIndex(tmp_path, MODEL)
+    _build(index, 2, [(5, None, _vec(0, 1))])
+    _build(index, 2, [(5, None, _vec(0, 1))])
+    assert _ids(MmapVectorIndex(tmp_path, "ollama:nomic-embed-text").search(_vec(1, 0), None, 5)) == [1]
+
+
+def test_interrupted_build_keeps_appends_visible_and_asks_for_rebuild(tmp_path):
+    index = MmapVectorIndex(tmp_path, MODEL)
+    _build(index, 2, [(1, None, _vec(1, 0))])
+    assert not index.build_interrupted()
+
+    # Worker killed (or DB error) after begin_build, before finish
+    handle = index.try_lock()
+    index.begin_build(2)
+    assert not index.build_interrupted()  # lock still held: a rebuild is running
+    index.unlock(handle)
+    assert index.build_interrupted()
+
+    index.append(OP_ADD, [(2, None, _vec(0, 1))])
+    reader = MmapVectorIndex(tmp_path, MODEL)
+    assert sorted(_ids(reader.search(_vec(1, 1), None, 5))) == [1, 2]
+    assert reader.log_records() == 1
+
+    # A second attempt that also dies must not hide the first one's log
+    handle = index.try_lock()
+    index.begin_build(2)
+    index.unlock(handle)
+    index.append(OP_DELETE, [(1, None, None)])
+    assert _ids(reader.search(_vec(1, 1), None, 5)) == [2]
+    assert reader.log_records() == 2
+
+    _build(index, 2, [(2, None, _vec(0, 1))])
+    assert not index.build_interrupted()
+    assert _ids(reader.search(_vec(1, 1), None, 5)) == [2]
+    assert reader.log_records() == 0
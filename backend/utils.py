@@ -1,12 +1,19 @@
 import base64
 from io import BytesIO
-from PIL import Image, ImageOps, ImageFilter
 import os
+import re
+import hashlib
+import unicodedata
 import requests
 
+# Pillow and pytesseract are imported inside the functions that need them to keep
+# application start-up cheap; annotations below are strings for the same reason.
+
 # Initial base from env; will be validated and possibly overridden
 _ENV_OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434").rstrip("/")
 _RESOLVED_OLLAMA_URL = None
+# Default per-request timeout (seconds) for Ollama calls; callers with a deadline pass a shorter one
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "120"))
 
 
 def _probe_ollama_base(base_url: str) -> bool:
@@ -39,61 +46,124 @@ def _get_ollama_base_url() -> str:
     return _RESOLVED_OLLAMA_URL
 
 
+def open_image(fp) -> "Image.Image":
+    from PIL import Image
+    return Image.open(fp)
+
+
 def image_to_base64(image_file) -> str:
     """
     Convert an image file to a base64-encoded string.
     """
-    image = Image.open(image_file)
+    image = open_image(image_file)
     buffered = BytesIO()
     image.save(buffered, format="PNG")
     img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
     return img_str
 
 
-def pil_image_to_base64_png(image: Image.Image) -> str:
+def pil_image_to_base64_png(image: "Image.Image") -> str:
     buffered = BytesIO()
     image.save(buffered, format="PNG")
     return base64.b64encode(buffered.getvalue()).decode("utf-8")
 
 
-def preprocess_image_for_ocr(image: Image.Image) -> Image.Image:
+def preprocess_image_for_ocr(image: "Image.Image") -> "Image.Image":
     """
     Light preprocessing to improve OCR performance:
     - Convert to grayscale
     - Auto-contrast
     - Slight sharpen
     """
+    from PIL import ImageOps, ImageFilter
     img = image.convert("L")
     img = ImageOps.autocontrast(img)
     img = img.filter(ImageFilter.SHARPEN)
     return img
 
 
-def ollama_generate(prompt, model="llama3"):
+def tesseract_image_to_string(image: "Image.Image", timeout: float = 0) -> str:
+    """timeout > 0 kills tesseract after that many seconds (pytesseract raises RuntimeError)."""
+    import pytesseract
+    return pytesseract.image_to_string(image, timeout=timeout)
+
+
+def tesseract_image_to_data(image: "Image.Image", timeout: float = 0) -> dict:
+    """
+    Tesseract with per-word confidences. Returns {"text", "mean_confidence", "words", "density"}:
+    text keeps Tesseract's line and paragraph breaks, mean_confidence (0-100) averages the
+    recognised words, and density is the fraction of the image covered by their boxes.
+    """
+    import pytesseract
+    data = pytesseract.image_to_data(image, output_type=pytesseract.Output.DICT, timeout=timeout)
+    lines: dict[tuple, list[str]] = {}
+    confidences = []
+    box_area = 0
+    for i, word in enumerate(data["text"]):
+        word = (word or "").strip()
+        conf = float(data["conf"][i])
+        if not word or conf < 0:
+            continue
+        confidences.append(conf)
+        box_area += data["width"][i] * data["height"][i]
+        lines.setdefault((data["block_num"][i], data["par_num"][i], data["line_num"][i]), []).append(word)
+    parts = []
+    previous = None
+    for key in sorted(lines):
+        if previous is not None:
+            parts.append("\n\n" if key[:2] != previous[:2] else "\n")
+        parts.append(" ".join(lines[key]))
+        previous = key
+    width, height = image.size
+    return {
+        "text": "".join(parts),
+        "mean_confidence": sum(confidences) / len(confidences) if confidences else 0.0,
+        "words": len(confidences),
+        "density": box_area / (width * height) if width and height else 0.0,
+    }
+
+
+def ollama_generate(prompt, model="llama3", timeout=None):
     base = _get_ollama_base_url()
     url = f"{base}/api/generate"
     payload = {"model": model, "prompt": prompt, "stream": False}
-    response = requests.post(url, json=payload)
+    response = requests.post(url, json=payload, timeout=timeout or OLLAMA_TIMEOUT)
     if response.status_code == 404:
         # Likely model not found; try to pull and retry once
-        _ollama_pull_model(model)
-        response = requests.post(url, json=payload)
+        _ollama_pull_model(model, timeout=timeout or 600)
+        response = requests.post(url, json=payload, timeout=timeout or OLLAMA_TIMEOUT)
     response.raise_for_status()
     return response.json().get("response", "")
 
 
-def ollama_embedding(text, model="llama3"):
+def ollama_embedding(text, model="llama3", timeout=None):
     base = _get_ollama_base_url()
     url = f"{base}/api/embeddings"
     payload = {"model": model, "prompt": text}
-    response = requests.post(url, json=payload)
+    response = requests.post(url, json=payload, timeout=timeout or OLLAMA_TIMEOUT)
     if response.status_code == 404:
-        _ollama_pull_model(model)
-        response = requests.post(url, json=payload)
+        _ollama_pull_model(model, timeout=timeout or 600)
+        response = requests.post(url, json=payload, timeout=timeout or OLLAMA_TIMEOUT)
     response.raise_for_status()
     return response.json().get("embedding", [])
 
 
+def ollama_embeddings(texts, model="llama3", timeout=None):
+    """Embed a batch of texts in one call via /api/embed; falls back to one call per text on older servers."""
+    base = _get_ollama_base_url()
+    url = f"{base}/api/embed"
+    payload = {"model": model, "input": list(texts)}
+    response = requests.post(url, json=payload, timeout=timeout or OLLAMA_TIMEOUT)
+    if response.status_code == 404:
+        _ollama_pull_model(model, timeout=timeout or 600)
+        response = requests.post(url, json=payload, timeout=timeout or OLLAMA_TIMEOUT)
+    if response.status_code == 404:
+        # Server predates /api/embed
+        return [ollama_embedding(t, model=model, timeout=timeout) for t in texts]
+    response.raise_for_status()
+    return response.json().get("embeddings", [])
+
+
 def ollama_list_models():
     base = _get_ollama_base_url()
     url = f"{base}/api/tags"
@@ -125,11 +195,132 @@ def ollama_list_running_models():
     return result
 
 
-def _ollama_pull_model(model: str):
+def _ollama_pull_model(model: str, timeout: float = 600):
     """Attempt to pull a model; ignore errors so caller can handle."""
     try:
         base = _get_ollama_base_url()
         url = f"{base}/api/pull"
-        requests.post(url, json={"name": model, "stream": False}, timeout=600)
+        requests.post(url, json={"name": model, "stream": False}, timeout=timeout)
+    except Exception:
+        pass 
+
+
+def perceptual_hash(image: "Image.Image", hash_size: int = 8) -> int:
+    """
+    Difference hash (dHash): robust to re-scans with small crop, scale or lighting changes.
+    Returns an unsigned hash_size*hash_size bit integer.
+    """
+    from PIL import Image
+    img = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(img.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (1 if pixels[offset + col] > pixels[offset + col + 1] else 0)
+    return value
+
+
+def split_into_passages(text: str, max_chars: int = 800, overlap_sentences: int = 1) -> list[str]:
+    """
+    Split text into passages of at most ~max_chars, packing whole sentences and
+    repeating the last overlap_sentences of a passage at the start of the next.
+    """
+    sentences = []
+    for paragraph in re.split(r"\n\s*\n", text or ""):
+        paragraph = " ".join(paragraph.split())
+        for sentence in re.split(r"(?<=[.!?])\s+", paragraph):
+            # Hard-wrap runs without punctuation (common in noisy OCR output)
+            while len(sentence) > max_chars:
+                sentences.append(sentence[:max_chars])
+                sentence = sentence[max_chars:]
+            if sentence.strip():
+                sentences.append(sentence.strip())
+    passages = []
+    current: list[str] = []
+    for sentence in sentences:
+        if current and len(" ".join(current + [sentence])) > max_chars:
+            passages.append(" ".join(current))
+            current = current[-overlap_sentences:] if overlap_sentences else []
+            if len(" ".join(current + [sentence])) > max_chars:
+                current = []
+        current.append(sentence)
+    if current:
+        passages.append(" ".join(current))
+    return passages
+
+
+def normalize_text(text: str) -> str:
+    """Canonical form used for matching: NFKC, case-folded, whitespace collapsed to single spaces."""
+    return " ".join(unicodedata.normalize("NFKC", text or "").casefold().split())
+
+
+def detect_language(text: str, min_chars: int = 20) -> str | None:
+    """ISO 639-1 code of the text's language, or None when there is too little text to tell."""
+    if len(text.strip()) < min_chars:
+        return None
+    try:
+        from langdetect import DetectorFactory, detect
+        DetectorFactory.seed = 0  # deterministic results for the same text
+        return detect(text)
     except Exception:
-        pass 
\ No newline at end of file
+        return None
+
+
+def text_features(text: str) -> dict:
+    """Derived columns stored with each text at ingest so reads never recompute them."""
+    text = text or ""
+    normalized = normalize_text(text)
+    return {
+        "char_count": len(text),
+        "word_count": len(normalized.split()),
+        "normalized_text": normalized,
+        "language": detect_language(text),
+        "content_hash": hashlib.sha256(normalized.encode("utf-8")).hexdigest(),
+    }
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """BK-tree over integer hashes for Hamming-radius queries."""
+
+    def __init__(self):
+        self._root = None  # (hash, [item ids], {distance: child})
+        self.size = 0
+
+    def add(self, hash_value: int, item_id: int):
+        self.size += 1
+        if self._root is None:
+            self._root = (hash_value, [item_id], {})
+            return
+        node = self._root
+        while True:
+            d = hamming_distance(hash_value, node[0])
+            if d == 0:
+                node[1].append(item_id)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = (hash_value, [item_id], {})
+                return
+            node = child
+
+    def search(self, hash_value: int, max_distance: int) -> list[tuple[int, int]]:
+        """Return (distance, item_id) pairs within max_distance, closest first."""
+        if self._root is None:
+            return []
+        found = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            d = hamming_distance(hash_value, node[0])
+            if d <= max_distance:
+                found.extend((d, item_id) for item_id in node[1])
+            for child_d, child in node[2].items():
+                if d - max_distance <= child_d <= d + max_distance:
+                    stack.append(child)
+        found.sort()
+        return found
@@ -0,0 +1,307 @@
+import os
+import re
+import json
+import fcntl
+import struct
+import threading
+from array import array
+from pathlib import Path
+import numpy as np
+
+# On-disk embedding index shared by every uvicorn worker.
+#
+# Per generation:
+#   <name>.<gen>.vec   float32 [count, dim], L2-normalised rows sorted by text id (memory-mapped read-only)
+#   <name>.<gen>.ids   int64   [count]
+#   <name>.<gen>.proj  int32   [count], -1 for texts without a project
+#   <name>.<gen>.log   fixed-size append records: op, text id, project id, vector
+# <name>.meta.json names the active generation ("gen") and the one new records go to ("append_gen").
+# A rebuild first moves append_gen forward, then snapshots the database, so a row committed
+# before the snapshot is in the new base and anything later lands in the new log. Until the
+# rebuild finishes (or if it dies), readers tail every log from gen up to append_gen.
+
+OP_ADD = b"A"
+OP_DELETE = b"D"
+_HEADER = struct.Struct("<cqi")
+_NO_PROJECT = -1
+
+
+class MmapVectorIndex:
+    def __init__(self, directory: str, model_key: str):
+        self.dir = Path(directory)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.name = re.sub(r"[^A-Za-z0-9_.-]", "_", model_key)
+        self.meta_path = self.dir / f"{self.name}.meta.json"
+        self.lock_path = self.dir / f"{self.name}.lock"
+        self.dim = None
+        self._gen = None
+        self._append_gen = None
+        self._meta_mtime = None
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._proj = np.zeros(0, dtype=np.int32)
+        self._vecs = np.zeros((0, 0), dtype=np.float32)
+        self._dead = np.zeros(0, dtype=bool)
+        self._log_offsets: dict[int, int] = {}
+        self._log_rows: dict[int, tuple[int, np.ndarray]] = {}
+        # Guards the mapped arrays and log state; searches only hold it while taking a snapshot
+        self._lock = threading.RLock()
+
+    def _path(self, gen: int, kind: str) -> Path:
+        return self.dir / f"{self.name}.{gen}.{kind}"
+
+    def _record_size(self) -> int:
+        return _HEADER.size + 4 * self.dim
+
+    def _read_meta(self) -> dict | None:
+        try:
+            with open(self.meta_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self, meta: dict):
+        tmp = self.meta_path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.meta_path)
+
+    @property
+    def ready(self) -> bool:
+        self.refresh()
+        return self._gen is not None
+
+    def refresh(self):
+        """Pick up a new generation and any log records written by other workers."""
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.meta_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._meta_mtime:
+            meta = self._read_meta()
+            if meta is None:
+                return
+            self._meta_mtime = mtime
+            self._append_gen = meta["append_gen"]
+            self.dim = meta["dim"]
+            if meta.get("gen") is None:
+                self._gen = None
+            elif meta["gen"] != self._gen:
+                self._load_generation(meta["gen"], meta["count"])
+        if self._gen is not None:
+            self._read_log()
+
+    def _load_generation(self, gen: int, count: int):
+        if count:
+            self._vecs = np.memmap(self._path(gen, "vec"), dtype=np.float32, mode="r", shape=(count, self.dim))
+            self._ids = np.memmap(self._path(gen, "ids"), dtype=np.int64, mode="r", shape=(count,))
+            self._proj = np.memmap(self._path(gen, "proj"), dtype=np.int32, mode="r", shape=(count,))
+        else:
+            self._vecs = np.zeros((0, self.dim), dtype=np.float32)
+            self._ids = np.zeros(0, dtype=np.int64)
+            self._proj = np.zeros(0, dtype=np.int32)
+        self._dead = np.zeros(count, dtype=bool)
+        self._gen = gen
+        self._log_offsets = {}
+        self._log_rows = {}
+
+    def _log_gens(self) -> range:
+        # Only the newest log still grows, so reading them in order replays records in order
+        return range(self._gen, max(self._gen, self._append_gen or 0) + 1)
+
+    def _read_log(self):
+        for gen in self._log_gens():
+            self._read_log_file(gen)
+
+    def _read_log_file(self, gen: int):
+        path = self._path(gen, "log")
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return
+        rec = self._record_size()
+        offset = self._log_offsets.get(gen, 0)
+        n = (size - offset) // rec
+        if n <= 0:
+            return
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read(n * rec)
+        self._log_offsets[gen] = offset + n * rec
+        for k in range(n):
+            op, tid, proj = _HEADER.unpack_from(data, k * rec)
+            # Any log record supersedes the base row for that id
+            pos = int(np.searchsorted(self._ids, tid))
+            if pos < len(self._ids) and self._ids[pos] == tid:
+                self._dead[pos] = True
+            if op == OP_ADD:
+                vec = np.frombuffer(data, dtype=np.float32, count=self.dim, offset=k * rec + _HEADER.size)
+                self._log_rows[tid] = (proj, vec)
+            else:
+                self._log_rows.pop(tid, None)
+
+    def log_records(self) -> int:
+        if self._gen is None or not self.dim:
+            return 0
+        total = 0
+        for gen in self._log_gens():
+            try:
+                total += os.path.getsize(self._path(gen, "log")) // self._record_size()
+            except FileNotFoundError:
+                pass
+        return total
+
+    def build_interrupted(self) -> bool:
+        """True when a rebuild moved append_gen forward but nobody is finishing it (worker killed, DB error)."""
+        meta = self._read_meta()
+        if meta is None or meta.get("append_gen") == meta.get("gen"):
+            return False
+        handle = self.try_lock()
+        if handle is None:
+            return False  # a rebuild is running
+        self.unlock(handle)
+        return True
+
+    def append(self, op: bytes, items) -> bool:
+        """Append (text_id, project_id, vector) records; vector is ignored for deletes.
+        Returns False when there is no index yet (the next build reads the database instead)."""
+        with self._lock:
+            return self._append(op, items)
+
+    def _append(self, op: bytes, items) -> bool:
+        self._refresh()
+        if self._append_gen is None or not self.dim:
+            return False
+        zero = np.zeros(self.dim, dtype=np.float32)
+        chunks = []
+        for tid, project_id, vec in items:
+            if op == OP_ADD:
+                v = np.asarray(vec, dtype=np.float32)
+                if v.shape != (self.dim,):
+                    continue
+                norm = float(np.linalg.norm(v))
+                v = v / norm if norm else v
+            else:
+                v = zero
+            chunks.append(_HEADER.pack(op, int(tid), _NO_PROJECT if project_id is None else int(project_id)))
+            chunks.append(v.tobytes())
+        if not chunks:
+            return True
+        data = b"".join(chunks)
+        fd = os.open(self._path(self._append_gen, "log"), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # One O_APPEND write per batch keeps records from different workers whole
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        return True
+
+    def search(self, query, project_id: int | None, limit: int) -> list[tuple[int, float]]:
+        # Snapshot under the lock, score outside it so appends never wait on the matrix product
+        with self._lock:
+            self._refresh()
+            if self._gen is None:
+                return []
+            dim = self.dim
+            ids, proj, vecs = self._ids, self._proj, self._vecs
+            dead = self._dead.copy()
+            log_rows = list(self._log_rows.items())
+        q = np.asarray(query, dtype=np.float32)
+        norm = float(np.linalg.norm(q))
+        if q.shape != (dim,) or not norm:
+            return []
+        q = q / norm
+        results: list[tuple[int, float]] = []
+        if len(ids):
+            scores = vecs @ q
+            mask = ~dead
+            if project_id is not None:
+                mask &= proj == project_id
+            scores = np.where(mask, scores, -np.inf)
+            k = min(limit, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            results.extend((int(ids[i]), float(scores[i])) for i in top if np.isfinite(scores[i]))
+        for tid, (row_project, vec) in log_rows:
+            if project_id is None or row_project == project_id:
+                results.append((tid, float(vec @ q)))
+        results.sort(key=lambda r: r[1], reverse=True)
+        return results[:limit]
+
+    def stats(self) -> dict:
+        self.refresh()
+        return {"ready": self._gen is not None, "generation": self._gen, "append_generation": self._append_gen, "base_count": len(self._ids), "log_records": self.log_records(), "dim": self.dim}
+
+    def try_lock(self):
+        """Non-blocking exclusive lock for rebuilds; returns a handle to pass to unlock() or None."""
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+        return fd
+
+    def unlock(self, handle):
+        fcntl.flock(handle, fcntl.LOCK_UN)
+        os.close(handle)
+
+    def begin_build(self, dim: int) -> "IndexBuilder":
+        """Start a new generation (caller holds try_lock); redirects appends before the DB snapshot."""
+        meta = self._read_meta() or {}
+        new_gen = max(meta.get("gen") or 0, meta.get("append_gen") or 0) + 1
+        if meta.get("dim") not in (None, dim):
+            meta["gen"] = None  # dimension changed: old generation is unusable
+        self._write_meta({"gen": meta.get("gen"), "count": meta.get("count", 0), "dim": dim, "append_gen": new_gen})
+        return IndexBuilder(self, new_gen, dim)
+
+
+class IndexBuilder:
+    def __init__(self, index: MmapVectorIndex, gen: int, dim: int):
+        self.index = index
+        self.gen = gen
+        self.dim = dim
+        self.count = 0
+        self._ids = array("q")
+        self._proj = array("i")
+        self._vec_file = open(index._path(gen, "vec"), "wb")
+
+    def add(self, rows):
+        """rows: (text_id, project_id, vector) in ascending text_id order."""
+        for tid, project_id, vec in rows:
+            v = np.asarray(vec, dtype=np.float32)
+            if v.shape != (self.dim,):
+                continue
+            norm = float(np.linalg.norm(v))
+            self._vec_file.write((v / norm if norm else v).tobytes())
+            self._ids.append(int(tid))
+            self._proj.append(_NO_PROJECT if project_id is None else int(project_id))
+            self.count += 1
+
+    def finish(self):
+        index = self.index
+        self._vec_file.flush()
+        os.fsync(self._vec_file.fileno())
+        self._vec_file.close()
+        with open(index._path(self.gen, "ids"), "wb") as f:
+            self._ids.tofile(f)
+        with open(index._path(self.gen, "proj"), "wb") as f:
+            self._proj.tofile(f)
+        old = index._read_meta() or {}
+        index._write_meta({"gen": self.gen, "count": self.count, "dim": self.dim, "append_gen": self.gen})
+        # Workers still mapping older generations keep their view until they refresh
+        pattern = re.compile(rf"^{re.escape(index.name)}\.(\d+)\.(vec|ids|proj|log)$")
+        for path in index.dir.iterdir():
+            m = pattern.match(path.name)
+            if m and int(m.group(1)) < self.gen:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+        return old.get("gen")